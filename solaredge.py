@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
+import time
+startTime = time.perf_counter()
+
 import argparse
+import bisect
+import contextvars
+import copy
 import datetime
+import hashlib
+import json
 import logging
-
-from aiohttp import ClientConnectionError
-from pyModbusTCP.client import ModbusClient
-from pymodbus.constants import Endian
-from pymodbus.payload import BinaryPayloadDecoder
+import os
+import struct
+import sys
+import threading
+import tracemalloc
+from collections import Counter, deque
+from contextlib import contextmanager
 import asyncio
-from aioinflux import InfluxDBClient, InfluxDBWriteError
-from prometheus_client import Gauge
-from prometheus_client import start_http_server
+
+# The sink libraries (aioinflux, prometheus_client) are imported when a sink is
+# configured, so a sink that is not used costs neither startup time nor memory
+prometheus_client = None
+exporterHandler = None
+influxErrors = ()
+history = None
 
 datapoint = {
     'measurement': 'SolarEdge',
@@ -20,194 +34,2041 @@ datapoint = {
 reg_block = {}
 promInv = {}
 promMeter = {}
+promMeterNames = {}
+lastWritten = {}
+serializers = {}
+promServer = {}
+config = {}
+proxyServer = {}
 logger = logging.getLogger('solaredge')
 
+# Register addresses of the common block and the meter block for each meter,
+# used when the inverter does not expose the SunSpec model chain
+METER_BLOCKS = {
+    1: (40123, 40188),
+    2: (40297, 40362),
+    3: (40471, 40537),
+}
+
+SUNSPEC_BASE = 40000
+SUNSPEC_MARKER = [0x5375, 0x6e53]
+SUNSPEC_END = 0xFFFF
+SUNSPEC_COMMON_MODEL = 1
+SUNSPEC_INVERTER_MODELS = (101, 102, 103)
+SUNSPEC_METER_MODELS = (201, 202, 203, 204)
+MAX_READ_REGISTERS = 125
+
+REGISTER_GROUPS = ('inverter', 'meters')
+
+DEFAULT_CONFIG = {
+    'interval': 5,
+    'intervals': {},
+    'legacy_support': False,
+    'config_poll': 5,
+    'devices': {
+        'inverter': {
+            'host': None,
+            'port': 1502,
+            'unitid': 1,
+            'timeout': 30,
+            'min_timeout': 1,
+            'timeout_factor': 4,
+            'hedge': True,
+            'pipeline': 4
+        },
+        'meters': 0
+    },
+    'register_groups': list(REGISTER_GROUPS),
+    'sinks': {
+        'influx': {
+            'host': '192.168.192.41',
+            'port': 8086,
+            'database': 'solaredgetemp'
+        },
+        'prometheus': {
+            'port': 2112
+        }
+    },
+    'deadbands': {},
+    'discovery': {
+        'enabled': True,
+        'cache': None
+    },
+    'energy': {
+        'enabled': False,
+        'state': None,
+        'interval': 900,
+        'checkpoint': 60,
+        'fields': ['AC_Energy_WH',
+                   'M_Exported', 'M_Exported_A', 'M_Exported_B', 'M_Exported_C',
+                   'M_Imported', 'M_Imported_A', 'M_Imported_B', 'M_Imported_C']
+    },
+    'proxy': {
+        'enabled': False,
+        'host': '0.0.0.0',
+        'port': 5020,
+        'max_age': 5
+    },
+    'history': {
+        'enabled': False,
+        'hours': 1,
+        'chunk': 600,
+        'max_bytes': 4 * 1024 * 1024
+    },
+    'profiling': {
+        'enabled': False,
+        'tracemalloc': False,
+        'sample_rate': 100
+    }
+}
+
+############################################################
+
+def str2bool(value):
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    if value.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    raise argparse.ArgumentTypeError(f'Boolean value expected, got {value}')
+
+
+def meters_arg(value):
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Number of meters or "auto" expected, got {value}')
+
+############################################################
+
+def merge_config(base, override):
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+# Settings shared by all InfluxDB endpoints, filled in when the sink is enabled
+INFLUX_DEFAULTS = {
+    'routing': 'hash',
+    'batch_size': 5000,
+    'flush_interval': 0,
+    'max_buffer': 100000
+}
+
+# Seconds a write may take before it counts as failed and is retried
+INFLUX_TIMEOUT = 30
+
+INFLUX_ENDPOINT_KEYS = ('host', 'port', 'ssl', 'database', 'org', 'bucket', 'token')
+
+
+def influx_endpoints(sinkcfg):
+    # Without an endpoints list the sink itself describes the only endpoint
+    if sinkcfg.get('endpoints'):
+        return sinkcfg['endpoints']
+    return [{key: sinkcfg[key] for key in INFLUX_ENDPOINT_KEYS if key in sinkcfg}]
+
+
+def validate_config(cfg):
+    def positive(value, name):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError(f'{name} must be a positive number, got {value!r}')
+
+    def section(value, default, name, allowed=None):
+        # A section must be an object and, unless its keys are free (intervals, deadbands),
+        # only hold the keys of its defaults
+        if not isinstance(value, dict):
+            raise ValueError(f'{name.rstrip(".") or "Configuration"} must be an object')
+        allowed = set(default) if allowed is None else allowed
+        unknown = set(value) - allowed if allowed else set()
+        if unknown:
+            raise ValueError(f'Unknown configuration keys: {", ".join(name + key for key in sorted(unknown))}')
+        for key, sub in default.items():
+            # The sinks are checked on their own below, as they can be null
+            if isinstance(sub, dict) and key in value and name != 'sinks.':
+                section(value[key], sub, f'{name}{key}.')
+
+    section(cfg, DEFAULT_CONFIG, '')
+
+    positive(cfg['interval'], 'interval')
+    positive(cfg['config_poll'], 'config_poll')
+    if not isinstance(cfg['legacy_support'], bool):
+        raise ValueError('legacy_support must be true or false')
+
+    inverter = cfg['devices']['inverter']
+    if not inverter['host'] or not isinstance(inverter['host'], str):
+        raise ValueError('devices.inverter.host is required')
+    for key in ('port', 'unitid', 'pipeline'):
+        if isinstance(inverter[key], bool) or not isinstance(inverter[key], int):
+            raise ValueError(f'devices.inverter.{key} must be an integer')
+    for key in ('timeout', 'min_timeout', 'timeout_factor'):
+        positive(inverter[key], f'devices.inverter.{key}')
+    if inverter['min_timeout'] > inverter['timeout']:
+        raise ValueError('devices.inverter.min_timeout must not be larger than devices.inverter.timeout')
+    if not isinstance(inverter['hedge'], bool):
+        raise ValueError('devices.inverter.hedge must be true or false')
+    positive(inverter['pipeline'], 'devices.inverter.pipeline')
+
+    discovery = cfg['discovery']
+    if not isinstance(discovery['enabled'], bool):
+        raise ValueError('discovery.enabled must be true or false')
+    if discovery['cache'] is not None and not isinstance(discovery['cache'], str):
+        raise ValueError('discovery.cache must be a file name')
+
+    # Meters may be given as 'auto', a count or a list of meter numbers. Without
+    # discovery only the three fixed meter blocks are known.
+    meters = cfg['devices']['meters']
+    maxmeters = None if discovery['enabled'] else len(METER_BLOCKS)
+    if meters == 'auto':
+        if maxmeters is not None:
+            raise ValueError('devices.meters cannot be auto with discovery disabled')
+    else:
+        if isinstance(meters, int) and not isinstance(meters, bool):
+            if meters < 0 or (maxmeters is not None and meters > maxmeters):
+                raise ValueError(f'devices.meters must be between 0 and {maxmeters}')
+            meters = list(range(1, meters+1))
+        if not isinstance(meters, list) or any(isinstance(x, bool) or not isinstance(x, int) or x < 1 for x in meters) \
+                or (maxmeters is not None and any(x > maxmeters for x in meters)):
+            raise ValueError('devices.meters must be auto, a count or a list of meter numbers')
+        cfg['devices']['meters'] = sorted(set(meters))
+
+    groups = cfg['register_groups']
+    if not isinstance(groups, list) or any(g not in REGISTER_GROUPS for g in groups):
+        raise ValueError(f'register_groups must be a list out of {list(REGISTER_GROUPS)}')
+    for group, value in cfg['intervals'].items():
+        if group not in REGISTER_GROUPS:
+            raise ValueError(f'intervals: unknown register group {group!r}')
+        positive(value, f'intervals.{group}')
+
+    influx = cfg['sinks'].get('influx')
+    if influx is not None:
+        section(influx, DEFAULT_CONFIG['sinks']['influx'], 'sinks.influx.',
+                set(INFLUX_DEFAULTS) | set(INFLUX_ENDPOINT_KEYS) | {'endpoints'})
+        influx = cfg['sinks']['influx'] = merge_config(INFLUX_DEFAULTS, influx)
+        if influx['routing'] not in ('hash', 'replicate'):
+            raise ValueError('sinks.influx.routing must be "hash" or "replicate"')
+        for key in ('batch_size', 'max_buffer'):
+            if isinstance(influx[key], bool) or not isinstance(influx[key], int) or influx[key] <= 0:
+                raise ValueError(f'sinks.influx.{key} must be a positive integer')
+        if isinstance(influx['flush_interval'], bool) or not isinstance(influx['flush_interval'], (int, float)) or influx['flush_interval'] < 0:
+            raise ValueError('sinks.influx.flush_interval must be a non-negative number')
+        endpoints = influx_endpoints(influx)
+        if not isinstance(endpoints, list) or not endpoints:
+            raise ValueError('sinks.influx.endpoints must be a non-empty list')
+        for i, endpoint in enumerate(endpoints):
+            name = f'sinks.influx.endpoints[{i}]' if influx.get('endpoints') else 'sinks.influx'
+            section(endpoint, {}, f'{name}.', set(INFLUX_ENDPOINT_KEYS))
+            # InfluxDB 2.x is addressed by org and bucket, 1.x by database
+            required = ('host', 'port', 'org', 'bucket', 'token') if endpoint.get('bucket') else ('host', 'port', 'database')
+            for key in required:
+                if not endpoint.get(key):
+                    raise ValueError(f'{name}.{key} is required')
+    prometheus = cfg['sinks'].get('prometheus')
+    if prometheus is not None:
+        section(prometheus, DEFAULT_CONFIG['sinks']['prometheus'], 'sinks.prometheus.')
+        if isinstance(prometheus.get('port'), bool) or not isinstance(prometheus.get('port'), int):
+            raise ValueError('sinks.prometheus.port must be an integer')
+
+    for field, value in cfg['deadbands'].items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f'deadbands.{field} must be a non-negative number')
+
+    energy = cfg['energy']
+    if not isinstance(energy['enabled'], bool):
+        raise ValueError('energy.enabled must be true or false')
+    if energy['state'] is not None and not isinstance(energy['state'], str):
+        raise ValueError('energy.state must be a file name')
+    positive(energy['interval'], 'energy.interval')
+    positive(energy['checkpoint'], 'energy.checkpoint')
+    if not isinstance(energy['fields'], list) or not all(isinstance(f, str) for f in energy['fields']):
+        raise ValueError('energy.fields must be a list of field names')
+
+    proxy = cfg['proxy']
+    if not isinstance(proxy['enabled'], bool):
+        raise ValueError('proxy.enabled must be true or false')
+    if not isinstance(proxy['host'], str):
+        raise ValueError('proxy.host must be a host name or address')
+    if isinstance(proxy['port'], bool) or not isinstance(proxy['port'], int):
+        raise ValueError('proxy.port must be an integer')
+    positive(proxy['max_age'], 'proxy.max_age')
+
+    history = cfg['history']
+    if not isinstance(history['enabled'], bool):
+        raise ValueError('history.enabled must be true or false')
+    for key in ('hours', 'chunk', 'max_bytes'):
+        positive(history[key], f'history.{key}')
+
+    profiling = cfg['profiling']
+    for key in ('enabled', 'tracemalloc'):
+        if not isinstance(profiling[key], bool):
+            raise ValueError(f'profiling.{key} must be true or false')
+    positive(profiling['sample_rate'], 'profiling.sample_rate')
+    return cfg
+
+
+def config_from_args(args):
+    cfg = copy.deepcopy(DEFAULT_CONFIG)
+    cfg['interval'] = args.interval
+    cfg['legacy_support'] = args.legacy_support
+    cfg['devices']['inverter'].update(
+        host=args.inverter_ip,
+        port=args.inverter_port,
+        unitid=args.unitid
+    )
+    cfg['devices']['meters'] = args.meters
+    cfg['discovery'] = {
+        'enabled': args.discovery,
+        'cache': args.discovery_cache
+    }
+    cfg['sinks']['influx'] = {
+        'host': args.influx_server,
+        'port': args.influx_port,
+        'database': args.influx_database
+    }
+    if args.influx_bucket:
+        cfg['sinks']['influx'].update(org=args.influx_org, bucket=args.influx_bucket, token=args.influx_token)
+    cfg['sinks']['prometheus'] = {
+        'port': args.prometheus_exporter_port
+    }
+    cfg['profiling']['enabled'] = args.profiling
+    if args.proxy_port:
+        cfg['proxy']['enabled'] = True
+        cfg['proxy']['port'] = args.proxy_port
+    if args.history_hours:
+        cfg['history']['enabled'] = True
+        cfg['history']['hours'] = args.history_hours
+    if args.energy_state:
+        cfg['energy']['enabled'] = True
+        cfg['energy']['state'] = args.energy_state
+    return cfg
+
+
+def load_config(path, base):
+    # The command line provides the defaults, the config file overrides them
+    with open(path) as f:
+        loaded = json.load(f)
+    if not isinstance(loaded, dict):
+        raise ValueError('Configuration must be a JSON object')
+    return validate_config(merge_config(base, loaded))
+
+
+async def watch_config(path, base):
+    global config
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError as e:
+        logger.error(f'Cannot watch configuration {path}: {e}')
+        return
+    while True:
+        await asyncio.sleep(config['config_poll'])
+        try:
+            newmtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            logger.error(f'Cannot read configuration {path}: {e}')
+            continue
+        if newmtime == mtime:
+            continue
+        mtime = newmtime
+        try:
+            newconfig = load_config(path, base)
+        except (OSError, ValueError) as e:
+            logger.error(f'Ignoring invalid configuration {path}: {e}')
+            continue
+        if newconfig != config:
+            logger.info(f'Configuration {path} changed, applying...')
+            config = newconfig
+
+############################################################
+
+# Register maps of the SunSpec inverter (101-103) and meter (201-204) models:
+# field name, offset from the model id register, type, offset of the scale factor
+INVERTER_REGISTERS = [
+    ('SunSpec_DID', 0, 'uint16', None),
+    ('SunSpec_Length', 1, 'uint16', None),
+    ('AC_Current', 2, 'uint16', 6),
+    ('AC_CurrentA', 3, 'uint16', 6),
+    ('AC_CurrentB', 4, 'uint16', 6),
+    ('AC_CurrentC', 5, 'uint16', 6),
+    ('AC_VoltageAB', 7, 'uint16', 13),
+    ('AC_VoltageBC', 8, 'uint16', 13),
+    ('AC_VoltageCA', 9, 'uint16', 13),
+    ('AC_VoltageAN', 10, 'uint16', 13),
+    ('AC_VoltageBN', 11, 'uint16', 13),
+    ('AC_VoltageCN', 12, 'uint16', 13),
+    ('AC_Power', 14, 'int16', 15),
+    ('AC_Frequency', 16, 'uint16', 17),
+    ('AC_VA', 18, 'int16', 19),
+    ('AC_VAR', 20, 'int16', 21),
+    ('AC_PF', 22, 'int16', 23),
+    ('AC_Energy_WH', 24, 'acc32', 26),
+    ('DC_Current', 27, 'uint16', 28),
+    ('DC_Voltage', 29, 'uint16', 30),
+    ('DC_Power', 31, 'int16', 32),
+    ('Temp_Sink', 34, 'int16', 37),
+    ('Status', 38, 'enum16', None),
+    ('Status_Vendor', 39, 'enum16', None),
+]
+
+METER_REGISTERS = [
+    ('M_SunSpec_DID', 0, 'uint16', None),
+    ('M_SunSpec_Length', 1, 'uint16', None),
+    ('M_AC_Current', 2, 'int16', 6),
+    ('M_AC_CurrentA', 3, 'int16', 6),
+    ('M_AC_CurrentB', 4, 'int16', 6),
+    ('M_AC_CurrentC', 5, 'int16', 6),
+    ('M_AC_VoltageLN', 7, 'int16', 15),
+    ('M_AC_VoltageAN', 8, 'int16', 15),
+    ('M_AC_VoltageBN', 9, 'int16', 15),
+    ('M_AC_VoltageCN', 10, 'int16', 15),
+    ('M_AC_VoltageLL', 11, 'int16', 15),
+    ('M_AC_VoltageAB', 12, 'int16', 15),
+    ('M_AC_VoltageBC', 13, 'int16', 15),
+    ('M_AC_VoltageCA', 14, 'int16', 15),
+    ('M_AC_Frequency', 16, 'int16', 17),
+    ('M_AC_Power', 18, 'int16', 22),
+    ('M_AC_Power_A', 19, 'int16', 22),
+    ('M_AC_Power_B', 20, 'int16', 22),
+    ('M_AC_Power_C', 21, 'int16', 22),
+    ('M_AC_VA', 23, 'int16', 27),
+    ('M_AC_VA_A', 24, 'int16', 27),
+    ('M_AC_VA_B', 25, 'int16', 27),
+    ('M_AC_VA_C', 26, 'int16', 27),
+    ('M_AC_VAR', 28, 'int16', 32),
+    ('M_AC_VAR_A', 29, 'int16', 32),
+    ('M_AC_VAR_B', 30, 'int16', 32),
+    ('M_AC_VAR_C', 31, 'int16', 32),
+    ('M_AC_PF', 33, 'int16', 37),
+    ('M_AC_PF_A', 34, 'int16', 37),
+    ('M_AC_PF_B', 35, 'int16', 37),
+    ('M_AC_PF_C', 36, 'int16', 37),
+    ('M_Exported', 38, 'acc32', 54),
+    ('M_Exported_A', 40, 'acc32', 54),
+    ('M_Exported_B', 42, 'acc32', 54),
+    ('M_Exported_C', 44, 'acc32', 54),
+    ('M_Imported', 46, 'acc32', 54),
+    ('M_Imported_A', 48, 'acc32', 54),
+    ('M_Imported_B', 50, 'acc32', 54),
+    ('M_Imported_C', 52, 'acc32', 54),
+]
+
+# Kept as constant 0.0 fields for existing dashboards, the scale factors are applied to the values
+INVERTER_SF_FIELDS = ['AC_Current_SF', 'AC_Voltage_SF', 'AC_Power_SF', 'AC_Frequency_SF', 'AC_VA_SF',
+                      'AC_VAR_SF', 'AC_PF_SF', 'AC_Energy_WH_SF', 'DC_Current_SF', 'DC_Voltage_SF',
+                      'DC_Power_SF', 'Temp_SF']
+METER_SF_FIELDS = ['M_AC_Current_SF', 'M_AC_Voltage_SF', 'M_AC_Frequency_SF', 'M_AC_Power_SF', 'M_AC_VA_SF',
+                   'M_AC_VAR_SF', 'M_AC_PF_SF', 'M_Energy_W_SF']
+
+INVERTER_FIELDS = [r[0] for r in INVERTER_REGISTERS] + INVERTER_SF_FIELDS
+METER_FIELDS = [r[0] for r in METER_REGISTERS] + METER_SF_FIELDS
+
+# SunSpec "not implemented" values, as raw unsigned register contents
+NOT_IMPLEMENTED = {
+    'uint16': 0xFFFF,
+    'enum16': 0xFFFF,
+    'int16': 0x8000,
+    'acc32': 0x00000000,
+    'uint32': 0xFFFFFFFF,
+}
+
+
+def decode_registers(reg_block, registers, sffields=()):
+    # Not implemented values, values with an invalid scale factor and registers beyond
+    # the block are left out, so they show up as gaps rather than as 0.0
+    size = len(reg_block)
+    scale = {}
+    for offset in {r[3] for r in registers if r[3] is not None and r[3] < size}:
+        sf = reg_block[offset]
+        sf = sf - 0x10000 if sf & 0x8000 else sf
+        if -10 <= sf <= 10:
+            scale[offset] = 10**sf
+    raw = [(name, reg_block[offset] << 16 | reg_block[offset+1] if kind in ('acc32', 'uint32') else reg_block[offset], kind, sfoffset)
+           for name, offset, kind, sfoffset in registers
+           if offset + (1 if kind in ('acc32', 'uint32') else 0) < size]
+    valid = [value != NOT_IMPLEMENTED[kind] and (sfoffset is None or sfoffset in scale)
+             for name, value, kind, sfoffset in raw]
+    decoded = {}
+    for (name, value, kind, sfoffset), ok in zip(raw, valid):
+        if not ok:
+            continue
+        if kind == 'int16' and value & 0x8000:
+            value -= 0x10000
+        decoded[name] = float(value) if sfoffset is None else float(value) * scale[sfoffset]
+    for name in sffields:
+        decoded[name] = 0.0
+    return decoded
+
 ############################################################
 
 def publish_metrics(dictobj, objtype, metriclabel, meternum=0, legacysupport=False):
 
     global datapoint
 
+    deadbands = config['deadbands']
+    prometheus = config['sinks'].get('prometheus') is not None
+
     if objtype == 'inverter':
         global promInv
         for key, value in dictobj.items():
             # InfluxDB metrics
-            datapoint['fields'][key] = value
+            if influx_changed(objtype, meternum, key, value, deadbands):
+                datapoint['fields'][key] = value
             # Prometheus Metrics
+            if not prometheus:
+                continue
             if key in promInv:
                 promInv[key].set(value)
             else:
-                promInv[key] = Gauge(key, key)
+                promInv[key] = prometheus_client.Gauge(key, key)
                 promInv[key].set(value)
+        # Registers that are no longer valid disappear from the snapshot
+        for key in [key for key in promInv if key not in dictobj]:
+            prometheus_client.REGISTRY.unregister(promInv.pop(key))
 
     if objtype == 'meter':
         global promMeter
+        published = set()
         for key, value in dictobj.items():
             # InfluxDB Metrics
-            datapoint['fields'][key] = value
+            if influx_changed(objtype, meternum, key, value, deadbands):
+                datapoint['fields'][key] = value
             # Prometheus Metrics
+            if not prometheus:
+                continue
             if meternum==1 and legacysupport==True:
+                published.add(key)
                 if key in promMeter:
                     promMeter[key].set(value)
                 else:
-                    promMeter[key] = Gauge(key, key + ' - ' + metriclabel)
+                    promMeter[key] = prometheus_client.Gauge(key, key + ' - ' + metriclabel)
                     promMeter[key].set(value)
             else:
                 metricname = key.replace('M_', 'M' + str(meternum) + '_')
+                published.add(metricname)
                 if metricname in promMeter:
                     promMeter[metricname].set(value)
                 else:
-                    promMeter[metricname] = Gauge(metricname, metricname + ' - ' + metriclabel)
-                    promMeter[metricname].set(value)               
-                   
+                    promMeter[metricname] = prometheus_client.Gauge(metricname, metricname + ' - ' + metriclabel)
+                    promMeter[metricname].set(value)
+        for metricname in promMeterNames.get(meternum, set()) - published:
+            if metricname in promMeter:
+                prometheus_client.REGISTRY.unregister(promMeter.pop(metricname))
+        promMeterNames[meternum] = published
+
+
+def retire_metrics(meters, inverter):
+    # Devices dropped from the configuration stop exporting their last values
+    if not inverter:
+        for key in list(promInv):
+            prometheus_client.REGISTRY.unregister(promInv.pop(key))
+    for meternum in [meternum for meternum in promMeterNames if meternum not in meters]:
+        for metricname in promMeterNames.pop(meternum):
+            if metricname in promMeter:
+                prometheus_client.REGISTRY.unregister(promMeter.pop(metricname))
+
+
+def influx_changed(objtype, meternum, key, value, deadbands):
+    # Skip fields that moved less than their configured deadband since the last write
+    deadband = deadbands.get(key)
+    if deadband is None:
+        return True
+    last = lastWritten.get((objtype, meternum, key))
+    if last is not None and abs(value - last) < deadband:
+        return False
+    lastWritten[(objtype, meternum, key)] = value
+    return True
+
 ############################################################
 
+def escape_key(value):
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
 
-async def write_to_influx(dbhost, dbport, mbmeters, period, dbname, legacysupport):
-    global client
-    global datapoint
-    global reg_block
-    global promInv
-    global promMeter
 
-    def trunc_float(floatval):
-        return float('%.2f' % floatval)
+class LineSerializer:
+    # Influx line protocol for one device. Measurement, tags and field keys are escaped
+    # once, each point only formats its values and timestamp into a reused buffer.
+    def __init__(self, measurement, tags, fields):
+        prefix = measurement.replace(',', '\\,').replace(' ', '\\ ')
+        for key, value in sorted(tags.items()):
+            prefix += ',' + escape_key(key) + '=' + escape_key(str(value))
+        self.prefix = (prefix + ' ').encode()
+        self.fields = tuple(fields)
+        self.keys = [(name, escape_key(name).encode() + b'=') for name in self.fields]
+        self.buffer = bytearray()
+
+    def serialize(self, values, timestamp):
+        buf = self.buffer
+        del buf[:]
+        buf += self.prefix
+        sep = b''
+        for name, key in self.keys:
+            value = values.get(name)
+            if value is None:
+                continue
+            buf += sep
+            buf += key
+            buf += b'%r' % float(value)
+            sep = b','
+        buf += b' %d' % timestamp
+        return bytes(buf)
+
+
+def get_serializer(dictobj, point):
+    # Built from the decoded register set the first time a device is seen
+    devicekey = tuple(sorted(point['tags'].items()))
+    serializer = serializers.get(devicekey)
+    if serializer is None or serializer.fields != tuple(dictobj):
+        serializer = LineSerializer(point['measurement'], point['tags'], dictobj)
+        serializers[devicekey] = serializer
+    return serializer
+
+############################################################
+
+def day_start(ts):
+    # Local midnight, so daily totals match the reports people look at
+    day = datetime.datetime.fromtimestamp(ts).date()
+    return datetime.datetime.combine(day, datetime.time()).timestamp()
+
+
+def next_day(start):
+    day = datetime.datetime.fromtimestamp(start).date() + datetime.timedelta(days=1)
+    return datetime.datetime.combine(day, datetime.time()).timestamp()
+
+
+class EnergyAccumulator:
+    # Turns lifetime energy counters into running per-day and per-interval totals.
+    # A delta between two samples is spread over the periods it covers in proportion
+    # to time, so gaps and restarts are interpolated instead of landing in one period.
+    def __init__(self, cfg):
+        self.state = cfg['state']
+        self.interval = cfg['interval']
+        self.checkpointInterval = cfg['checkpoint']
+        self.fields = set(cfg['fields'])
+        self.counters = {}
+        self.periods = {}
+        self.lastCheckpoint = time.monotonic()
+        if self.state:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.state) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f'Cannot read energy state {self.state}: {e}')
+            return
+        self.counters = state.get('counters', {})
+        if state.get('interval') == self.interval:
+            self.periods = state.get('periods', {})
+        logger.info(f'Energy state restored from {self.state}')
+
+    def checkpoint(self, force=False):
+        if not self.state or not (force or time.monotonic() - self.lastCheckpoint >= self.checkpointInterval):
+            return
+        self.lastCheckpoint = time.monotonic()
+        state = {'interval': self.interval, 'counters': self.counters, 'periods': self.periods}
+        try:
+            with open(self.state + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(self.state + '.tmp', self.state)
+        except OSError as e:
+            logger.error(f'Cannot write energy state {self.state}: {e}')
+
+    def boundaries(self, kind, ts):
+        if kind == 'day':
+            start = day_start(ts)
+            return start, next_day(start)
+        start = ts - ts % self.interval
+        return start, start + self.interval
+
+    def spread(self, key, field, start, end, delta, touched):
+        for kind in ('day', 'interval'):
+            totals = self.periods.setdefault(key, {}).setdefault(kind, {})
+            t = start
+            while t < end:
+                pstart, pend = self.boundaries(kind, t)
+                segment = min(end, pend)
+                pkey = str(int(pstart))
+                totals[pkey] = totals.get(pkey, 0.0) + delta * (segment - t) / (end - start)
+                touched.setdefault((kind, pkey), {})[field] = totals[pkey]
+                t = segment
+            # Finished periods were written when they were last touched
+            current = str(int(self.boundaries(kind, end)[0]))
+            for pkey in [pkey for pkey in totals if int(pkey) < int(current)]:
+                del totals[pkey]
+
+    def update(self, tags, dictobj, timestamp):
+        # Returns the line protocol of every period total that changed
+        ts = timestamp / 1e9
+        device = ','.join(f'{k}={v}' for k, v in sorted(tags.items()))
+        touched = {}
+        for field, value in dictobj.items():
+            if field not in self.fields:
+                continue
+            key = device + '/' + field
+            last = self.counters.get(key)
+            self.counters[key] = [value, ts]
+            if last is None or ts <= last[1]:
+                continue
+            delta = value - last[0]
+            if delta < 0:
+                # Counter reset (e.g. replaced meter), count what it accumulated since
+                logger.warning(f'Energy counter {key} went backwards from {last[0]} to {value}')
+                delta = value
+            self.spread(key, field, last[1], ts, delta, touched)
+
+        lines = []
+        for (kind, pkey), fields in sorted(touched.items()):
+            point = {
+                'measurement': 'SolarEdgeEnergy',
+                'tags': dict(tags, period=kind),
+                'fields': fields,
+                'time': int(pkey) * 1000000000
+            }
+            lines.append(get_serializer(fields, point).serialize(fields, point['time']))
+        self.checkpoint()
+        return lines
+
+############################################################
+
+class BitWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, bits):
+        self.acc = (self.acc << bits) | (value & ((1 << bits) - 1))
+        self.nbits += bits
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.data.append((self.acc >> self.nbits) & 0xFF)
+        self.acc &= (1 << self.nbits) - 1
+
+    def getvalue(self):
+        # The written bits so far, the last byte padded with zeros
+        if self.nbits:
+            return bytes(self.data) + bytes([(self.acc << (8 - self.nbits)) & 0xFF])
+        return bytes(self.data)
+
+
+class BitReader:
+    def __init__(self, data):
+        self.value = int.from_bytes(data, 'big')
+        self.left = len(data) * 8
+
+    def read(self, bits):
+        self.left -= bits
+        return (self.value >> self.left) & ((1 << bits) - 1)
+
+
+def float_bits(value):
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+
+def bits_float(bits):
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+
+# Delta-of-delta timestamp buckets (milliseconds): prefix, prefix length, value bits
+DOD_BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12)]
+
+
+class HistoryChunk:
+    # One stretch of a series, compressed like Gorilla: delta-of-delta timestamps and
+    # XOR'ed floats, so a slowly changing value costs a few bits per sample
+    def __init__(self, ts, value):
+        self.start = self.end = ts
+        self.count = 1
+        self.bits = BitWriter()
+        self.bits.write(ts, 64)
+        self.bits.write(float_bits(value), 64)
+        self.delta = 0
+        self.value = float_bits(value)
+        self.leading = self.trailing = None
+
+    def append(self, ts, value):
+        delta = ts - self.end
+        dod = delta - self.delta
+        if dod == 0:
+            self.bits.write(0, 1)
+        else:
+            for prefix, length, bits in DOD_BUCKETS:
+                if -(1 << (bits - 1)) <= dod < (1 << (bits - 1)):
+                    self.bits.write(prefix, length)
+                    self.bits.write(dod, bits)
+                    break
+            else:
+                self.bits.write(0b1111, 4)
+                self.bits.write(dod, 64)
+        self.delta = delta
+        self.end = ts
+
+        current = float_bits(value)
+        xor = current ^ self.value
+        self.value = current
+        self.count += 1
+        if xor == 0:
+            self.bits.write(0, 1)
+            return
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if self.leading is not None and leading >= self.leading and trailing >= self.trailing:
+            self.bits.write(0b10, 2)
+            self.bits.write(xor >> self.trailing, 64 - self.leading - self.trailing)
+        else:
+            self.leading, self.trailing = leading, trailing
+            self.bits.write(0b11, 2)
+            self.bits.write(leading, 5)
+            self.bits.write(64 - leading - trailing - 1, 6)
+            self.bits.write(xor >> trailing, 64 - leading - trailing)
+
+    def snapshot(self):
+        # The samples so far, to decode without holding the buffer lock
+        return self.bits.getvalue(), self.count
+
+    def samples(self, snapshot=None):
+        data, count = snapshot or self.snapshot()
+        reader = BitReader(data)
+        ts = reader.read(64)
+        value = reader.read(64)
+        yield ts, bits_float(value)
+        delta = 0
+        leading = trailing = 0
+        for i in range(count - 1):
+            if reader.read(1):
+                for prefix, length, bits in DOD_BUCKETS:
+                    if reader.read(1) == 0:
+                        break
+                else:
+                    bits = 64
+                dod = reader.read(bits)
+                if dod >= 1 << (bits - 1):
+                    dod -= 1 << bits
+                delta += dod
+            ts += delta
+            if reader.read(1):
+                if reader.read(1):
+                    leading = reader.read(5)
+                    trailing = 64 - leading - reader.read(6) - 1
+                value ^= reader.read(64 - leading - trailing) << trailing
+            yield ts, bits_float(value)
+
+    def size(self):
+        return len(self.bits.data) + 64
+
+
+class HistoryBuffer:
+    # Recent samples of every field, kept within a time window and a memory budget
+    def __init__(self, cfg):
+        self.retention = cfg['hours'] * 3600 * 1000
+        self.chunkLength = cfg['chunk'] * 1000
+        self.maxBytes = cfg['max_bytes']
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def record(self, device, fields, timestamp):
+        ts = timestamp // 1000000
+        with self.lock:
+            for name, value in fields.items():
+                if name.endswith('_SF') or not isinstance(value, (int, float)):
+                    continue
+                chunks = self.series.setdefault((device, name), [])
+                if chunks and chunks[-1].start + self.chunkLength > ts > chunks[-1].end:
+                    chunks[-1].append(ts, value)
+                elif not chunks or ts > chunks[-1].end:
+                    chunks.append(HistoryChunk(ts, value))
+
+    def trim(self, now):
+        with self.lock:
+            chunks = [(chunk.end, key) for key, series in self.series.items() for chunk in series]
+            total = sum(chunk.size() for series in self.series.values() for chunk in series)
+            # Oldest chunks go first, whether they aged out or the budget is exceeded. That
+            # can be the only chunk of a series, which then starts again with the next poll.
+            for end, key in sorted(chunks):
+                if end >= now - self.retention and total <= self.maxBytes:
+                    break
+                series = self.series[key]
+                total -= series.pop(0).size()
+                if not series:
+                    del self.series[key]
+
+    def fields(self):
+        with self.lock:
+            devices = {}
+            for device, name in self.series:
+                devices.setdefault(device, []).append(name)
+            return devices
+
+    def query(self, device, name, start, end, step):
+        with self.lock:
+            chunks = [(chunk, chunk.snapshot()) for chunk in self.series.get((device, name), [])
+                      if chunk.end >= start and chunk.start <= end]
+        points = [(ts, value) for chunk, snapshot in chunks for ts, value in chunk.samples(snapshot)
+                  if start <= ts <= end]
+        if not step:
+            return points
+        # Average per step, stamped at the start of the step
+        buckets = {}
+        for ts, value in points:
+            bucket = buckets.setdefault(ts - ts % step, [0.0, 0])
+            bucket[0] += value
+            bucket[1] += 1
+        return [(ts, total / count) for ts, (total, count) in sorted(buckets.items())]
+
+############################################################
+
+# Frames a thread sits in while it waits for work, left out of the samples
+IDLE_FRAMES = {('selectors.py', 'select'), ('threading.py', 'wait'), ('queue.py', 'get')}
+
+
+class StageProfiler:
+    # CPU time per pipeline stage. Only synchronous sections are timed (with the thread's
+    # CPU clock), as an await lets other tasks run on the same thread. Async code is
+    # labelled per task with a context variable, which its synchronous sections inherit.
+    # The stage each thread is running is kept for the sampler.
+    def __init__(self):
+        self.enabled = False
+        self.totals = {}
+        self.counts = {}
+        self.current = {}
+        self.label = contextvars.ContextVar('stage', default=None)
+        # The exporter threads update the totals too, and read them for /debug/stages
+        self.lock = threading.Lock()
+        self.promCounter = None
+        self.allocations = ''
+        self.snapshot = None
+
+    def begin(self, name=None):
+        # Synchronous section, the name defaults to the label of the running task
+        if not self.enabled:
+            return None
+        name = name or self.label.get() or 'other'
+        ident = threading.get_ident()
+        previous = self.current.get(ident)
+        self.current[ident] = name
+        return name, previous, time.thread_time()
+
+    def end(self, started):
+        if started is None:
+            return
+        name, previous, cpu = started
+        elapsed = time.thread_time() - cpu
+        ident = threading.get_ident()
+        if previous is None:
+            self.current.pop(ident, None)
+        else:
+            self.current[ident] = previous
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed
+            self.counts[name] = self.counts.get(name, 0) + 1
+        if self.promCounter is not None:
+            self.promCounter.labels(name).inc(elapsed)
+
+    def stages(self):
+        with self.lock:
+            return {name: {'seconds': self.totals[name], 'count': self.counts[name]} for name in self.totals}
+
+    @contextmanager
+    def stage(self, name=None):
+        started = self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(started)
+
+    @contextmanager
+    def task(self, name):
+        # Labels the awaits inside for the synchronous sections they run, without timing them
+        token = self.label.set(name)
+        try:
+            yield
+        finally:
+            self.label.reset(token)
+
+    def apply(self, cfg):
+        self.enabled = cfg['enabled']
+        if self.enabled and self.promCounter is None and config['sinks'].get('prometheus') is not None:
+            self.promCounter = load_prometheus().Counter('solaredge_stage_seconds', 'CPU time spent per poller stage', ['stage'])
+        if cfg['tracemalloc'] and self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        elif not (cfg['tracemalloc'] and self.enabled) and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self.snapshot = None
+            self.allocations = ''
+
+    def snapshot_allocations(self, limit=25):
+        # Allocation growth since the previous poll cycle
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ])
+        if self.snapshot is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            lines = [f'# traced: {current} bytes, peak: {peak} bytes']
+            for stat in snapshot.compare_to(self.snapshot, 'lineno')[:limit]:
+                lines.append(str(stat))
+            self.allocations = '\n'.join(lines) + '\n'
+        self.snapshot = snapshot
+
+    def sample(self, seconds, rate):
+        # Poor man's sampling profiler, returns stacks in the folded flamegraph format
+        stacks = Counter()
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append('stage:' + self.current.get(ident, 'other'))
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(1 / rate)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+profiler = StageProfiler()
+
+
+def load_prometheus():
+    global prometheus_client
+    if prometheus_client is None:
+        import prometheus_client as module
+        prometheus_client = module
+    return prometheus_client
+
+
+def exporter_handler():
+    global exporterHandler
+    if exporterHandler is not None:
+        return exporterHandler
+    from urllib.parse import parse_qs, urlparse
+
+    class ExporterHandler(load_prometheus().MetricsHandler):
+        # Prometheus metrics on every path, plus the /debug/ profiling endpoints when enabled
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/history':
+                return self.send_history(parse_qs(url.query))
+            if not url.path.startswith('/debug/'):
+                with profiler.stage('prometheus_http'):
+                    return super().do_GET()
+            if not profiler.enabled:
+                return self.send_text(404, 'Profiling is not enabled\n')
+            query = parse_qs(url.query)
+            if url.path == '/debug/profile':
+                try:
+                    seconds = min(float(query.get('seconds', ['10'])[0]), 300)
+                except ValueError:
+                    return self.send_text(400, 'Invalid seconds\n')
+                return self.send_text(200, profiler.sample(seconds, config['profiling']['sample_rate']))
+            if url.path == '/debug/stages':
+                stages = profiler.stages()
+                return self.send_text(200, json.dumps(stages, indent=2) + '\n', 'application/json')
+            if url.path == '/debug/allocations':
+                if not tracemalloc.is_tracing():
+                    return self.send_text(404, 'tracemalloc is not enabled\n')
+                return self.send_text(200, profiler.allocations or 'No snapshot yet\n')
+            return self.send_text(404, 'Unknown debug endpoint\n')
+
+        def send_history(self, query):
+            if history is None:
+                return self.send_text(404, 'History is not enabled\n')
+            if 'field' not in query:
+                return self.send_text(200, json.dumps(history.fields()) + '\n', 'application/json')
+            # Times in milliseconds, a negative start or end is relative to now
+            now = time.time_ns() // 1000000
+            try:
+                start = int(query.get('start', ['-3600000'])[0])
+                end = int(query.get('end', [str(now)])[0])
+                step = int(query.get('step', ['0'])[0])
+            except ValueError:
+                return self.send_text(400, 'start, end and step must be integers\n')
+            start = now + start if start < 0 else start
+            end = now + end if end < 0 else end
+            device = query.get('device', ['inverter'])[0]
+            field = query['field'][0]
+            points = history.query(device, field, start, end, max(step, 0))
+            body = {'device': device, 'field': field, 'points': points}
+            return self.send_text(200, json.dumps(body) + '\n', 'application/json')
+
+        def send_text(self, code, text, contenttype='text/plain; charset=utf-8'):
+            body = text.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', contenttype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    exporterHandler = ExporterHandler
+    return exporterHandler
+
+############################################################
+
+# Error codes as used by pyModbusTCP
+MB_NO_ERR = 0
+MB_CONNECT_ERR = 2
+MB_SEND_ERR = 3
+MB_RECV_ERR = 4
+MB_TIMEOUT_ERR = 5
+MB_FRAME_ERR = 6
+MB_EXCEPT_ERR = 7
+
+# Consecutive timeouts after which the connection is dropped and reopened
+MB_RECONNECT_TIMEOUTS = 2
+# Clean requests one at a time before pipelining is tried again, doubled after every fallback
+PIPELINE_RETRY = 100
+PIPELINE_RETRY_MAX = 6400
+
+MODBUS_ILLEGAL_FUNCTION = 0x01
+MODBUS_ILLEGAL_DATA_VALUE = 0x03
+MODBUS_GATEWAY_TARGET_FAILED = 0x0B
+
+# Round trips kept per device, and how many are needed before the timeout adapts
+RTT_SAMPLES = 200
+RTT_MIN_SAMPLES = 20
+# Smallest block a read is split into when the device rejects the size
+MIN_READ_REGISTERS = 8
+# Reads at a reduced size before trying larger blocks again
+READ_REGROW = 100
+
+
+class RegisterBlock(list):
+    # The registers of one read, stamped with the time (ns since the epoch) the device most likely sampled them
+    def __init__(self, registers, timestamp):
+        super().__init__(registers)
+        self.timestamp = timestamp
+
+    @classmethod
+    def join(cls, blocks):
+        # A block read in pieces is stamped with the middle of the pieces
+        return cls([register for block in blocks for register in block],
+                   sum(block.timestamp for block in blocks) // len(blocks))
+
+
+class ModbusTransport:
+    # ModBus TCP client that keeps several transactions in flight on one connection
+    # and matches the responses by transaction id. A device that times out or drops
+    # the connection while requests are pipelined is switched to one at a time.
+    # Timeouts follow the measured round trip times of the device, between
+    # min_timeout and timeout, and reads that are slow to answer can be hedged.
+    def __init__(self, host, port, unitid, timeout, pipeline, min_timeout=None, timeout_factor=4, hedge=False):
+        self._host = host
+        self.port = port
+        self.unitid = unitid
+        self.configure(timeout, pipeline, min_timeout, timeout_factor, hedge)
+        self.rtts = deque(maxlen=RTT_SAMPLES)
+        self.timeouts = 0
+        self.stalls = 0
+        self.hedged = 0
+        self.maxRead = MAX_READ_REGISTERS
+        self.reducedReads = 0
+        self.connectLock = asyncio.Lock()
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.pending = {}
+        self.tid = 0
+        self.error = MB_NO_ERR
+        self.exception = 0
+
+    def configure(self, timeout, pipeline, min_timeout=None, timeout_factor=4, hedge=False):
+        # Tuning that can change on a reload without reconnecting
+        self.timeout = timeout
+        self.minTimeout = timeout if min_timeout is None else min_timeout
+        self.timeoutFactor = timeout_factor
+        self.hedge = hedge
+        self.pipeline = pipeline
+        self.depth = pipeline
+        self.slots = asyncio.Semaphore(pipeline)
+        self.serialRetry = PIPELINE_RETRY
+        self.serialRequests = 0
+
+    def host(self):
+        return self._host
+
+    def last_error(self):
+        return self.error
+
+    def last_except(self):
+        return self.exception
+
+    async def connect(self):
+        async with self.connectLock:
+            if self.writer is not None:
+                return True
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self._host, self.port), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                self.error = MB_CONNECT_ERR
+                return False
+            self.receiver = asyncio.ensure_future(self.receive(self.reader))
+            return True
+
+    async def receive(self, reader):
+        try:
+            while True:
+                tid, pid, length, unit = struct.unpack('>HHHB', await reader.readexactly(7))
+                if length < 2:
+                    raise ValueError(f'invalid MBAP length {length}')
+                pdu = await reader.readexactly(length - 1)
+                with profiler.stage('modbus'):
+                    future = self.pending.pop(tid, None)
+                    # Responses to transactions that already timed out are dropped
+                    if future is not None and not future.done():
+                        future.set_result(pdu)
+        except Exception as e:
+            # Anything that stops the receiver also ends the connection, the next request reconnects
+            if reader is self.reader:
+                self.disconnect(ConnectionError(f'Connection lost: {e}'))
+
+    def disconnect(self, exc):
+        if self.writer is not None:
+            self.writer.close()
+        if self.receiver is not None:
+            self.receiver.cancel()
+        self.reader = self.writer = self.receiver = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+    def close(self):
+        self.disconnect(ConnectionError('Connection closed'))
+
+    def rtt_quantile(self, q):
+        ordered = sorted(self.rtts)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def current_timeout(self):
+        if len(self.rtts) < RTT_MIN_SAMPLES:
+            return self.timeout
+        # Every timeout since the last answer doubles the timeout, so a device that got slower
+        # than the estimate still gets to answer and feed new round trips into it
+        estimate = max(self.rtt_quantile(0.99) * self.timeoutFactor, self.minTimeout)
+        return min(estimate * 2 ** self.timeouts, self.timeout)
+
+    def hedge_delay(self):
+        # Reads are idempotent, so one that takes longer than nearly all others is sent a second time
+        if not self.hedge or self.depth < 2 or len(self.rtts) < RTT_MIN_SAMPLES:
+            return None
+        return self.rtt_quantile(0.95) * 2
+
+    def rtt_stats(self):
+        if not self.rtts:
+            return {}
+        return {'p50': self.rtt_quantile(0.5), 'p99': self.rtt_quantile(0.99),
+                'timeout': self.current_timeout(), 'hedged': self.hedged, 'max_read': self.maxRead}
+
+    async def send(self, pdu):
+        with profiler.stage():
+            self.tid = (self.tid + 1) & 0xFFFF
+            tid = self.tid
+            future = asyncio.get_event_loop().create_future()
+            self.pending[tid] = future
+            self.writer.write(struct.pack('>HHHB', tid, 0, len(pdu) + 1, self.unitid) + pdu)
+        await self.writer.drain()
+        return future
+
+    async def receive_any(self, pdu, future):
+        # Wait for the response, sending a hedge request for a read that is late
+        timeout = self.current_timeout()
+        started = time.monotonic()
+        sent = {future: started}
+        delay = self.hedge_delay() if pdu[0] == 3 else None
+        if delay is not None and delay < timeout:
+            await asyncio.wait([future], timeout=delay)
+            if not future.done() and self.writer is not None:
+                try:
+                    sent[await self.send(pdu)] = time.monotonic()
+                    self.hedged += 1
+                    logger.debug(f'ModBus device {self._host}: hedged a read after {delay:.3f}s')
+                except OSError:
+                    # A broken connection also fails the first request
+                    pass
+        try:
+            done, _ = await asyncio.wait(list(sent), timeout=started + timeout - time.monotonic(),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError
+            first = done.pop()
+            response = first.result()
+            received = time.monotonic()
+            self.rtts.append(received - sent[first])
+            self.timeouts = 0
+            self.stalls = 0
+            # The device sampled the registers somewhere in the round trip, its middle is the best
+            # guess. Measured on the monotonic clock, so a wall clock step during it does not matter
+            return response, time.time_ns() - int((received - sent[first]) / 2 * 1e9)
+        finally:
+            # A late answer to the other request is dropped by the receiver
+            for tid in [tid for tid, pending in self.pending.items() if pending in sent]:
+                del self.pending[tid]
+
+    def fallback(self, reason):
+        if self.depth > 1:
+            logger.warning(f'ModBus device {self._host} {reason} with pipelined requests, falling back to one request '
+                           f'at a time for the next {self.serialRetry} requests')
+            self.depth = 1
+            self.slots = asyncio.Semaphore(1)
+            self.serialRequests = 0
+
+    def serial_success(self):
+        # A blip (network, inverter restart) should not end pipelining for good
+        if self.depth == 1 and self.pipeline > 1:
+            self.serialRequests += 1
+            if self.serialRequests >= self.serialRetry:
+                logger.info(f'ModBus device {self._host}: trying {self.pipeline} pipelined requests again')
+                self.serialRetry = min(self.serialRetry * 2, PIPELINE_RETRY_MAX)
+                self.depth = self.pipeline
+                self.slots = asyncio.Semaphore(self.pipeline)
 
+    async def request(self, pdu):
+        return (await self.exchange(pdu))[0]
+
+    async def exchange(self, pdu):
+        # The response and the time the device answered it at, see receive_any
+        async with self.slots:
+            if not await self.connect():
+                return None, None
+            # Requests that fail while others were in flight are retried one at a time
+            pipelined = len(self.pending) > 0 and self.depth > 1
+            try:
+                future = await self.send(pdu)
+            except OSError as e:
+                self.error = MB_SEND_ERR
+                self.disconnect(ConnectionError(f'Send failed: {e}'))
+                return None, None
+            try:
+                response, stamp = await self.receive_any(pdu, future)
+            except asyncio.TimeoutError:
+                self.error = MB_TIMEOUT_ERR
+                if self.current_timeout() < self.timeout:
+                    self.timeouts += 1
+                if pipelined:
+                    self.fallback('timed out')
+                    return await self.exchange(pdu)
+                # A session that stopped answering is reopened, SolarEdge inverters do not recover it
+                self.stalls += 1
+                if self.stalls >= MB_RECONNECT_TIMEOUTS:
+                    logger.warning(f'ModBus device {self._host} timed out {self.stalls} times in a row, reconnecting')
+                    self.stalls = 0
+                    self.disconnect(ConnectionError('Reconnecting after timeouts'))
+                return None, None
+            except ConnectionError:
+                self.error = MB_RECV_ERR
+                if pipelined:
+                    self.fallback('dropped the connection')
+                    return await self.exchange(pdu)
+                return None, None
+            if response[0] == pdu[0] | 0x80 and len(response) == 2:
+                self.error = MB_EXCEPT_ERR
+                self.exception = response[1]
+                return None, None
+            if response[0] != pdu[0]:
+                self.error = MB_FRAME_ERR
+                if pipelined:
+                    self.fallback('mixed up responses')
+                    return await self.exchange(pdu)
+                return None, None
+            self.error = MB_NO_ERR
+            self.serial_success()
+            return response, stamp
+
+    async def read_holding_registers(self, address, count):
+        # Blocks larger than the device accepts are read in pieces, in flight together
+        if count > self.maxRead:
+            pieces = [(start, min(self.maxRead, address + count - start))
+                      for start in range(address, address + count, self.maxRead)]
+            results = await asyncio.gather(*[self.read_block(*piece) for piece in pieces])
+            if not all(results):
+                return None
+            return RegisterBlock.join(results)
+        return await self.read_block(address, count)
+
+    async def read_block(self, address, count):
+        response, stamp = await self.exchange(struct.pack('>BHH', 3, address, count))
+        if response is None:
+            if self.error == MB_EXCEPT_ERR and self.exception == MODBUS_ILLEGAL_DATA_VALUE and count > MIN_READ_REGISTERS:
+                return await self.split_read(address, count)
+            return None
+        if len(response) != 2 + 2 * count or response[1] != 2 * count:
+            self.error = MB_RECV_ERR
+            return None
+        if self.maxRead < MAX_READ_REGISTERS:
+            # Try larger blocks again once in a while, the limit may have been a passing gateway problem
+            self.reducedReads += 1
+            if self.reducedReads >= READ_REGROW:
+                self.reducedReads = 0
+                self.maxRead = min(self.maxRead * 2, MAX_READ_REGISTERS)
+                logger.info(f'ModBus device {self._host}: trying reads of up to {self.maxRead} registers again')
+        with profiler.stage():
+            return RegisterBlock(struct.unpack(f'>{count}H', response[2:]), stamp)
+
+    async def split_read(self, address, count):
+        # An illegal data value for a large block may be the gateway's PDU size limit: if both
+        # halves can be read it was, and later reads use the smaller size
+        half = (count + 1) // 2
+        first = await self.read_block(address, half)
+        second = await self.read_block(address + half, count - half) if first else None
+        if not second:
+            return None
+        if half < self.maxRead:
+            self.maxRead = half
+            self.reducedReads = 0
+            logger.warning(f'ModBus device {self._host} rejected a read of {count} registers, reading at most {half} at a time')
+        return RegisterBlock.join([first, second])
+
+    async def write_single_register(self, address, value):
+        pdu = struct.pack('>BHH', 6, address, value)
+        return await self.request(pdu) == pdu
+
+    async def write_multiple_registers(self, address, values):
+        pdu = struct.pack(f'>BHHB{len(values)}H', 16, address, len(values), len(values) * 2, *values)
+        return await self.request(pdu) == pdu[:5]
+
+############################################################
+
+class RegisterCache:
+    # The most recently read register blocks, keyed by start address
+    def __init__(self):
+        self.blocks = {}
+
+    def store(self, address, registers):
+        self.blocks[address] = (list(registers), time.monotonic())
+
+    def lookup(self, address, count, maxage):
+        now = time.monotonic()
+        for start, (registers, stamp) in self.blocks.items():
+            if start <= address and address + count <= start + len(registers) and now - stamp <= maxage:
+                return registers[address - start:address - start + count]
+        return None
+
+    def invalidate(self, address, count):
+        for start in [start for start, (registers, stamp) in self.blocks.items()
+                      if start < address + count and address < start + len(registers)]:
+            del self.blocks[start]
+
+registerCache = RegisterCache()
+
+
+async def read_registers(client, address, count):
+    reg_block = await client.read_holding_registers(address, count)
+    if reg_block:
+        registerCache.store(address, reg_block)
+    return reg_block
+
+
+async def read_blocks(client, plan, labelled):
+    # Send all blocks of a cycle at once, the transport keeps them in flight together
+    requests = []
+    if plan['inverter']:
+        requests.append((None, plan['inverter']))
+    for x, block in plan['meters'].items():
+        if x in labelled:
+            requests.append((x, block))
+    results = await asyncio.gather(*[read_registers(client, *block) for x, block in requests])
+    blocks = {'inverter': None, 'meters': {}}
+    for (x, block), result in zip(requests, results):
+        if x is None:
+            blocks['inverter'] = result
+        else:
+            blocks['meters'][x] = result
+    return blocks
+
+############################################################
+
+def proxy_failure(fc, upstream):
+    # Pass a ModBus exception from the device through, so clients see the real reason
+    if upstream is not None and upstream.last_error() == MB_EXCEPT_ERR:
+        return bytes([fc | 0x80, upstream.last_except()])
+    return bytes([fc | 0x80, MODBUS_GATEWAY_TARGET_FAILED])
+
+
+async def proxy_request(pdu):
+    # Answer one ModBus PDU, from the register cache where possible and otherwise
+    # over the poller's own connection, as SolarEdge inverters accept only one client
+    fc = pdu[0]
+    upstream = client
+    if fc == 3 and len(pdu) == 5:
+        address, count = struct.unpack('>HH', pdu[1:5])
+        if not 1 <= count <= MAX_READ_REGISTERS:
+            return bytes([fc | 0x80, MODBUS_ILLEGAL_DATA_VALUE])
+        registers = registerCache.lookup(address, count, config['proxy']['max_age'])
+        if registers is None and upstream is not None:
+            registers = await read_registers(upstream, address, count)
+        if not registers:
+            return proxy_failure(fc, upstream)
+        return struct.pack(f'>BB{count}H', fc, count * 2, *registers)
+    if fc == 6 and len(pdu) == 5:
+        address, value = struct.unpack('>HH', pdu[1:5])
+        registerCache.invalidate(address, 1)
+        if upstream is None or not await upstream.write_single_register(address, value):
+            return proxy_failure(fc, upstream)
+        return pdu
+    if fc == 16 and len(pdu) >= 6:
+        address, count, bytecount = struct.unpack('>HHB', pdu[1:6])
+        if not 1 <= count <= 123 or bytecount != count * 2 or len(pdu) != 6 + bytecount:
+            return bytes([fc | 0x80, MODBUS_ILLEGAL_DATA_VALUE])
+        registerCache.invalidate(address, count)
+        values = list(struct.unpack(f'>{count}H', pdu[6:]))
+        if upstream is None or not await upstream.write_multiple_registers(address, values):
+            return proxy_failure(fc, upstream)
+        return pdu[:5]
+    return bytes([fc | 0x80, MODBUS_ILLEGAL_FUNCTION])
+
+
+async def handle_proxy_client(reader, writer):
+    peer = writer.get_extra_info('peername')
+    logger.debug(f'ModBus proxy client {peer} connected')
+    profiler.label.set('proxy')
     try:
-        solar_client = InfluxDBClient(host=dbhost, port=dbport, db=dbname)
-        await solar_client.create_database(db=dbname)
-    except ClientConnectionError as e:
-        logger.error(f'Error during connection to InfluxDb {dbhost}: {e}')
+        while True:
+            header = await reader.readexactly(7)
+            tid, pid, length, unit = struct.unpack('>HHHB', header)
+            if pid != 0 or not 2 <= length <= 254:
+                break
+            pdu = await reader.readexactly(length - 1)
+            response = await proxy_request(pdu)
+            with profiler.stage():
+                writer.write(struct.pack('>HHHB', tid, 0, len(response) + 1, unit) + response)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        logger.debug(f'ModBus proxy client {peer} disconnected')
+        writer.close()
+
+
+async def start_proxy(proxycfg):
+    wanted = (proxycfg['host'], proxycfg['port']) if proxycfg['enabled'] else None
+    if proxyServer.get('address') == wanted:
         return
-    logger.info('Database opened and initialized')
-    
-    # Connect to the solaredge inverter
-    client = ModbusClient(args.inverter_ip, port=args.inverter_port, unit_id=args.unitid, auto_open=True)
-    
-    # Read the common blocks on the Inverter
-    while True:
-        reg_block = {}
-        reg_block = client.read_holding_registers(40004, 65)
-        if reg_block:
-            decoder = BinaryPayloadDecoder.fromRegisters(reg_block, byteorder=Endian.Big, wordorder=Endian.Big)
-            InvManufacturer = decoder.decode_string(32).decode('UTF-8') #decoder.decode_32bit_float(),
-            InvModel = decoder.decode_string(32).decode('UTF-8') #decoder.decode_32bit_int(),
-            Invfoo = decoder.decode_string(16).decode('UTF-8')
-            InvVersion = decoder.decode_string(16).decode('UTF-8') #decoder.decode_bits()
-            InvSerialNumber = decoder.decode_string(32).decode('UTF-8')
-            InvDeviceAddress = decoder.decode_16bit_uint()
-
-            print('*' * 60)
-            print('* Inverter Info')
-            print('*' * 60)
-            print(' Manufacturer: ' + InvManufacturer)
-            print(' Model: ' + InvModel)
-            print(' Version: ' + InvVersion)
-            print(' Serial Number: ' + InvSerialNumber)
-            print(' ModBus ID: ' + str(InvDeviceAddress))
-            break
+    if proxyServer:
+        proxyServer['server'].close()
+        await proxyServer['server'].wait_closed()
+        proxyServer.clear()
+    if wanted is None:
+        return
+    try:
+        server = await asyncio.start_server(handle_proxy_client, *wanted)
+    except OSError as e:
+        logger.error(f'Cannot start ModBus proxy on {wanted[0]}:{wanted[1]}: {e}')
+        return
+    logger.info(f'ModBus proxy listening on {wanted[0]}:{wanted[1]}')
+    proxyServer.update(address=wanted, server=server)
+
+############################################################
+
+def log_modbus_error(client):
+    # Error during data receive
+    if client.last_error() == 2:
+        logger.error(f'Failed to connect to SolarEdge inverter {client.host()}!')
+    elif client.last_error() == 3 or client.last_error() == 4:
+        logger.error('Send or receive error!')
+    elif client.last_error() == 5:
+        logger.error('Timeout during send or receive operation!')
+
+
+def decode_string(reg_block, offset, count):
+    # Two big endian characters per register
+    return struct.pack(f'>{count}H', *reg_block[offset:offset+count]).decode('UTF-8')
+
+
+async def read_inverter_info(client, address):
+    reg_block = await read_registers(client, address, 65)
+    if not reg_block:
+        return False
+    InvManufacturer = decode_string(reg_block, 0, 16)
+    InvModel = decode_string(reg_block, 16, 16)
+    Invfoo = decode_string(reg_block, 32, 8)
+    InvVersion = decode_string(reg_block, 40, 8)
+    InvSerialNumber = decode_string(reg_block, 48, 16)
+    InvDeviceAddress = reg_block[64]
+
+    print('*' * 60)
+    print('* Inverter Info')
+    print('*' * 60)
+    print(' Manufacturer: ' + InvManufacturer)
+    print(' Model: ' + InvModel)
+    print(' Version: ' + InvVersion)
+    print(' Serial Number: ' + InvSerialNumber)
+    print(' ModBus ID: ' + str(InvDeviceAddress))
+    return True
+
+
+async def read_meter_info(client, x, address):
+    reg_block = await read_registers(client, address, 65)
+    if not reg_block:
+        return None
+    MManufacturer = decode_string(reg_block, 0, 16)
+    MModel = decode_string(reg_block, 16, 16)
+    MOption = decode_string(reg_block, 32, 8)
+    MVersion = decode_string(reg_block, 40, 8)
+    MSerialNumber = decode_string(reg_block, 48, 16)
+    MDeviceAddress = reg_block[64]
+    fooLabel = MManufacturer.split('\x00')[0] + '(' + MSerialNumber.split('\x00')[0] + ')'
+    print('*' * 60)
+    print('* Meter ' + str(x) + ' Info')
+    print('*' * 60)
+    print(' Manufacturer: ' + MManufacturer)
+    print(' Model: ' + MModel)
+    print(' Mode: ' + MOption)
+    print(' Version: ' + MVersion)
+    print(' Serial Number: ' + MSerialNumber)
+    print(' ModBus ID: ' + str(MDeviceAddress))
+    print('*' * 60)
+    return fooLabel
+
+############################################################
+
+def legacy_models():
+    # The fixed SolarEdge layout: a three phase inverter and up to three meters
+    return {
+        'common': 40004,
+        'inverter': {'model': None, 'common': 40004, 'address': 40069, 'length': 50},
+        'meters': {x: {'model': None, 'common': common, 'address': address, 'length': 105}
+                   for x, (common, address) in METER_BLOCKS.items()},
+        'models': []
+    }
+
+
+def build_device_table(models):
+    # Every device starts with a common model, followed by its own model(s)
+    table = {'common': None, 'inverter': None, 'meters': {}, 'models': models}
+    common = None
+    for did, address, length in models:
+        if did == SUNSPEC_COMMON_MODEL:
+            common = address + 2
+            if table['common'] is None:
+                table['common'] = common
+        elif did in SUNSPEC_INVERTER_MODELS and table['inverter'] is None:
+            table['inverter'] = {'model': did, 'common': common, 'address': address, 'length': length}
+        elif did in SUNSPEC_METER_MODELS:
+            table['meters'][len(table['meters'])+1] = {'model': did, 'common': common, 'address': address, 'length': length}
         else:
-            # Error during data receive
-            if client.last_error() == 2:
-                logger.error(f'Failed to connect to SolarEdge inverter {client.host()}!')
-            elif client.last_error() == 3 or client.last_error() == 4:
-                logger.error('Send or receive error!')
-            elif client.last_error() == 5:
-                logger.error('Timeout during send or receive operation!')
-            await asyncio.sleep(period)
-
-    # Read the common blocks on the meter/s (if present)
-    connflag = False
-    if mbmeters >= 1:
+            # Storage models (124 and the 800 series) are not decoded either
+            logger.info(f'SunSpec model {did} at register {address} is not polled')
+    return table
+
+
+async def discover_models(client):
+    # Walk the SunSpec model chain starting at the 'SunS' marker
+    marker = await read_registers(client, SUNSPEC_BASE, 2)
+    if not marker:
+        return None
+    if marker != SUNSPEC_MARKER:
+        logger.warning(f'No SunSpec marker at register {SUNSPEC_BASE}, using the fixed register layout')
+        return legacy_models()
+    models = []
+    address = SUNSPEC_BASE + 2
+    while len(models) < 64:
+        header = await read_registers(client, address, 2)
+        if not header:
+            return None
+        did, length = header
+        if did == SUNSPEC_END:
+            break
+        models.append([did, address, length])
+        address += 2 + length
+    table = build_device_table(models)
+    if table['common'] is None:
+        logger.warning('No SunSpec common model found, using the fixed register layout')
+        return legacy_models()
+    return table
+
+
+def read_models_cache(path, key):
+    try:
+        with open(path) as f:
+            models = json.load(f)[key]
+    except (OSError, ValueError, KeyError):
+        return None
+    return build_device_table(models)
+
+
+def write_models_cache(path, key, table):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = table['models']
+    try:
+        with open(path, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        logger.error(f'Cannot write SunSpec model cache {path}: {e}')
+
+
+async def load_models(client, cfg, usecache=True):
+    if not cfg['discovery']['enabled']:
+        return legacy_models()
+    inverter = cfg['devices']['inverter']
+    key = f'{inverter["host"]}:{inverter["port"]}/{inverter["unitid"]}'
+    cachefile = cfg['discovery']['cache']
+    table = read_models_cache(cachefile, key) if cachefile and usecache else None
+    if table is None:
         while True:
-            dictMeterLabel = []
-            for x in range(1, mbmeters+1):
-                reg_block = {}
-                if x==1:
-                    reg_block = client.read_holding_registers(40123, 65)
-                if x==2:
-                    reg_block = client.read_holding_registers(40297, 65)
-                if x==3:
-                    reg_block = client.read_holding_registers(40471, 65)       
-                if reg_block:
-                    decoder = BinaryPayloadDecoder.fromRegisters(reg_block, byteorder=Endian.Big, wordorder=Endian.Big)
-                    MManufacturer = decoder.decode_string(32).decode('UTF-8') #decoder.decode_32bit_float(),
-                    MModel = decoder.decode_string(32).decode('UTF-8') #decoder.decode_32bit_int(),
-                    MOption = decoder.decode_string(16).decode('UTF-8')
-                    MVersion = decoder.decode_string(16).decode('UTF-8') #decoder.decode_bits()
-                    MSerialNumber = decoder.decode_string(32).decode('UTF-8')
-                    MDeviceAddress = decoder.decode_16bit_uint()
-                    fooLabel = MManufacturer.split('\x00')[0] + '(' + MSerialNumber.split('\x00')[0] + ')'
-                    dictMeterLabel.append(fooLabel)
-                    print('*' * 60)
-                    print('* Meter ' + str(x) + ' Info')
-                    print('*' * 60)
-                    print(' Manufacturer: ' + MManufacturer)
-                    print(' Model: ' + MModel)
-                    print(' Mode: ' + MOption)
-                    print(' Version: ' + MVersion)
-                    print(' Serial Number: ' + MSerialNumber)
-                    print(' ModBus ID: ' + str(MDeviceAddress))
-                    if x==mbmeters:
-                        print('*' * 60)
-                    connflag = True
-                else:
-                    # Error during data receive
-                    if client.last_error() == 2:
-                        logger.error(f'Failed to connect to SolarEdge inverter {client.host()}!')
-                    elif client.last_error() == 3 or client.last_error() == 4:
-                        logger.error('Send or receive error!')
-                    elif client.last_error() == 5:
-                        logger.error('Timeout during send or receive operation!')
-                    await asyncio.sleep(period)
-            if connflag:
+            table = await discover_models(client)
+            if table is not None:
                 break
+            log_modbus_error(client)
+            await asyncio.sleep(cfg['interval'])
+        if cachefile and table['models']:
+            write_models_cache(cachefile, key, table)
+
+    print('*' * 60)
+    print('* SunSpec Models')
+    print('*' * 60)
+    for did, address, length in table['models']:
+        print(f' Model {did}: Register {address} Length {length}')
+    return table
+
+
+def select_meters(cfg, models):
+    meters = cfg['devices']['meters']
+    if meters == 'auto':
+        return list(models['meters'])
+    return [x for x in meters if x in models['meters']]
+
+
+def plan_reads(models, meters, pollgroups):
+    # Register blocks to poll this cycle, sized to the models that are actually present
+    def block(model):
+        return (model['address'], min(model['length'] + 2, MAX_READ_REGISTERS))
+
+    plan = {'inverter': None, 'meters': {}}
+    if 'inverter' in pollgroups and models['inverter'] is not None:
+        plan['inverter'] = block(models['inverter'])
+    if 'meters' in pollgroups:
+        for x in meters:
+            plan['meters'][x] = block(models['meters'][x])
+    return plan
+
+############################################################
+
+def start_prometheus(sinkcfg):
+    port = sinkcfg['port'] if sinkcfg is not None else None
+    if promServer.get('port') == port:
+        return
+    if promServer:
+        logger.debug(f'Stopping Prometheus exporter on port {promServer["port"]}...')
+        promServer['httpd'].shutdown()
+        promServer['httpd'].server_close()
+        promServer.clear()
+    if port is None:
+        return
+    logger.debug(f'Starting Prometheus exporter on port {port}...')
+    from http.server import ThreadingHTTPServer
+    try:
+        httpd = ThreadingHTTPServer(('', port), exporter_handler())
+    except OSError as e:
+        logger.error(f'Cannot start Prometheus exporter on port {port}: {e}')
+        return
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='prometheus-exporter', daemon=True).start()
+    promServer.update(port=port, httpd=httpd)
+
+
+class InfluxEndpoint:
+    # One InfluxDB server with its own write buffer and retry back-off. It is opened on
+    # the first write, so a server that is down only delays its own lines.
+    def __init__(self, cfg, sinkcfg):
+        self.cfg = cfg
+        self.name = f'{cfg["host"]}:{cfg["port"]}/{cfg.get("bucket") or cfg["database"]}'
+        self.configure(sinkcfg)
+        self.buffer = []
+        self.lastFlush = 0
+        self.retryAt = 0
+        self.failures = 0
+        self.opened = False
+        self.client = None
+        self.session = None
+        self.flushing = None
+
+    def configure(self, sinkcfg):
+        self.batchSize = sinkcfg['batch_size']
+        self.flushInterval = sinkcfg['flush_interval']
+        self.maxBuffer = sinkcfg['max_buffer']
+
+    async def open(self):
+        from aiohttp import ClientConnectionError, ClientSession, ClientTimeout
+        from aioinflux import InfluxDBClient
+        if self.cfg.get('bucket'):
+            # InfluxDB 2.x: aioinflux only speaks the 1.x API, so the write endpoint is posted to directly
+            self.session = ClientSession(headers={'Authorization': f'Token {self.cfg["token"]}'}, timeout=ClientTimeout(total=INFLUX_TIMEOUT))
+        else:
+            self.client = InfluxDBClient(host=self.cfg['host'], port=self.cfg['port'], db=self.cfg['database'], ssl=self.cfg.get('ssl', False))
+            try:
+                await asyncio.wait_for(self.client.create_database(db=self.cfg['database']), INFLUX_TIMEOUT)
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                await self.client.close()
+                self.client = None
+                raise ConnectionError(e or 'timed out') from e
+        self.opened = True
+        logger.info(f'Database {self.name} opened and initialized')
+
+    def add(self, lines):
+        self.buffer.extend(lines)
+        self.trim()
+
+    def trim(self):
+        if len(self.buffer) > self.maxBuffer:
+            dropped = len(self.buffer) - self.maxBuffer
+            del self.buffer[:dropped]
+            logger.warning(f'InfluxDb {self.name}: buffer full, dropped the {dropped} oldest lines')
+
+    def due(self, now):
+        if not self.buffer or now < self.retryAt:
+            return False
+        return len(self.buffer) >= self.batchSize or now - self.lastFlush >= self.flushInterval
+
+    async def post(self, body):
+        if self.client is not None:
+            return await self.client.write(body)
+        from aioinflux import InfluxDBWriteError
+        scheme = 'https' if self.cfg.get('ssl') else 'http'
+        params = {'org': self.cfg['org'], 'bucket': self.cfg['bucket'], 'precision': 'ns'}
+        async with self.session.post(f'{scheme}://{self.cfg["host"]}:{self.cfg["port"]}/api/v2/write', params=params, data=body) as resp:
+            if resp.status != 204:
+                raise InfluxDBWriteError(resp)
+
+    def failed(self, what, e):
+        self.failures += 1
+        backoff = min(2 ** self.failures, 300)
+        self.retryAt = time.monotonic() + backoff
+        logger.error(f'Failed to {what} InfluxDb {self.name}, retrying in {backoff}s: {e or "timed out"}')
+
+    async def flush(self):
+        self.lastFlush = time.monotonic()
+        if not self.opened:
+            try:
+                await self.open()
+            except ConnectionError as e:
+                self.failed('open', e)
+                return
+        while self.buffer:
+            # The batch leaves the buffer while it is sent, as the poller keeps adding (and trimming) lines
+            batch = self.buffer[:self.batchSize]
+            del self.buffer[:len(batch)]
+            try:
+                with profiler.stage():
+                    body = b'\n'.join(batch)
+                await asyncio.wait_for(self.post(body), INFLUX_TIMEOUT)
+            except influxErrors as e:
+                status = getattr(e, 'status', None)
+                if status is not None and 400 <= status < 500 and status not in (401, 403, 429):
+                    # The data itself was rejected, retrying will not help
+                    logger.error(f'InfluxDb {self.name} rejected {len(batch)} lines: {e}')
+                    continue
+                self.buffer[:0] = batch
+                self.trim()
+                self.failed('write to', e)
+                return
+            self.failures = 0
+            self.retryAt = 0
+
+    async def guarded_flush(self):
+        try:
+            with profiler.task('influx_write'):
+                await self.flush()
+        except Exception as e:
+            logger.error(f'Unhandled exception writing to InfluxDb {self.name}: {e}')
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+        if self.session is not None:
+            await self.session.close()
+
+
+class InfluxSink:
+    # Spreads the lines of each device over the endpoints, either on a consistent hash ring
+    # (a device stays on its endpoint when endpoints are added or removed) or to all of them
+    def __init__(self, sinkcfg, previous=()):
+        # Endpoints whose settings did not change are kept, with their buffers and retry state
+        kept = {json.dumps(endpoint.cfg, sort_keys=True): endpoint for endpoint in previous}
+        self.endpoints = []
+        for cfg in influx_endpoints(sinkcfg):
+            endpoint = kept.pop(json.dumps(cfg, sort_keys=True), None) or InfluxEndpoint(cfg, sinkcfg)
+            endpoint.configure(sinkcfg)
+            self.endpoints.append(endpoint)
+        self.retired = list(kept.values())
+        self.replicate = sinkcfg['routing'] == 'replicate'
+        self.ring = sorted((self.hash(f'{endpoint.name}#{i}'), n)
+                           for n, endpoint in enumerate(self.endpoints) for i in range(100))
+        self.routes = {}
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def route(self, key):
+        if self.replicate:
+            return self.endpoints
+        if key not in self.routes:
+            i = bisect.bisect(self.ring, (self.hash(key),)) % len(self.ring)
+            self.routes[key] = [self.endpoints[self.ring[i][1]]]
+        return self.routes[key]
+
+    def add(self, key, lines):
+        for endpoint in self.route(key):
+            endpoint.add(lines)
+
+    def start_flush(self):
+        # Every endpoint writes in its own task next to the poller, so a slow endpoint
+        # delays neither the next poll nor the other endpoints
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if (endpoint.flushing is None or endpoint.flushing.done()) and endpoint.due(now):
+                endpoint.flushing = asyncio.ensure_future(endpoint.guarded_flush())
+
+
+async def retire_endpoints(endpoints):
+    # Endpoints dropped from the configuration write what they still hold once more, then close
+    await asyncio.gather(*(endpoint.flushing for endpoint in endpoints if endpoint.flushing is not None))
+    await asyncio.gather(*(endpoint.guarded_flush() for endpoint in endpoints if endpoint.opened and endpoint.buffer))
+    for endpoint in endpoints:
+        await endpoint.close()
+
+
+def open_influx(sinkcfg, previous=None):
+    # The new sink takes over the unchanged endpoints of the previous one, the others
+    # are closed in the background so the poller does not wait for them
+    global influxErrors
+
+    endpoints = previous.endpoints if previous is not None else []
+    sink = None
+    if sinkcfg is not None:
+        from aiohttp import ClientError
+        from aioinflux import InfluxDBWriteError
+        influxErrors = (InfluxDBWriteError, ClientError, asyncio.TimeoutError)
+        sink = InfluxSink(sinkcfg, endpoints)
+        endpoints = sink.retired
+    if endpoints:
+        asyncio.ensure_future(retire_endpoints(endpoints))
+    return sink
+
+############################################################
+
+
+async def write_to_influx(configpath=None, baseconfig=None):
+    global client
+    global history
+    global datapoint
+    global reg_block
+    global promInv
+    global promMeter
+
+    client = None
+    solar_client = None
+    energy = None
+    applied = {}
+    models = None
+    modelsStale = False
+    dictMeterLabel = {}
+    nextPoll = {}
 
     # Start the loop for collecting the metrics...
     while True:
+        # Apply a new configuration, keeping whatever did not change
+        cfg = config
+        if cfg is not applied:
+            if cfg['sinks'].get('influx') != applied.get('sinks', {}).get('influx'):
+                solar_client = open_influx(cfg['sinks'].get('influx'), solar_client)
+            start_prometheus(cfg['sinks'].get('prometheus'))
+            profiler.apply(cfg['profiling'])
+            await start_proxy(cfg['proxy'])
+            if cfg['history'] != applied.get('history'):
+                history = HistoryBuffer(cfg['history']) if cfg['history']['enabled'] else None
+            if cfg['energy'] != applied.get('energy'):
+                if energy is not None:
+                    energy.checkpoint(True)
+                energy = EnergyAccumulator(cfg['energy']) if cfg['energy']['enabled'] else None
+
+            inverter = cfg['devices']['inverter']
+            tuning = (inverter['timeout'], inverter['pipeline'], inverter['min_timeout'], inverter['timeout_factor'], inverter['hedge'])
+            previous = applied.get('devices', {}).get('inverter', {})
+            if any(inverter[key] != previous.get(key) for key in ('host', 'port', 'unitid')):
+                # Connect to the solaredge inverter
+                if client is not None:
+                    client.close()
+                client = ModbusTransport(inverter['host'], inverter['port'], inverter['unitid'], *tuning)
+                models = None
+            else:
+                if inverter != previous:
+                    client.configure(*tuning)
+                if cfg['discovery'] != applied.get('discovery'):
+                    models = None
+            if configpath and not applied:
+                asyncio.ensure_future(watch_config(configpath, baseconfig))
+            applied = cfg
+
+        period = cfg['interval']
+        legacysupport = cfg['legacy_support']
+
+        if models is None:
+            models = await load_models(client, cfg, not modelsStale)
+            modelsStale = False
+            dictMeterLabel = {}
+            # Read the common blocks on the Inverter
+            while not await read_inverter_info(client, models['common']):
+                log_modbus_error(client)
+                await asyncio.sleep(period)
+
+        # Work out which register groups are due in this cycle
+        now = time.monotonic()
+        pollgroups = []
+        for group in cfg['register_groups']:
+            if now >= nextPoll.get(group, 0):
+                pollgroups.append(group)
+                nextPoll[group] = now + cfg['intervals'].get(group, period)
+
+        meters = select_meters(cfg, models)
+        retire_metrics(meters if 'meters' in cfg['register_groups'] else [], 'inverter' in cfg['register_groups'])
+        plan = plan_reads(models, meters, pollgroups)
+
+        # Read the common blocks on the meter/s (if present)
+        for x in plan['meters']:
+            if x not in dictMeterLabel:
+                fooLabel = await read_meter_info(client, x, models['meters'][x]['common'])
+                if fooLabel is None:
+                    log_modbus_error(client)
+                else:
+                    dictMeterLabel[x] = fooLabel
+
         try:
             reg_block = {}
             dictInv = {}
-            reg_block = client.read_holding_registers(40069, 50)
+            with profiler.task('modbus'):
+                blocks = await read_blocks(client, plan, dictMeterLabel)
+            logger.debug(f'ModBus round trips: {client.rtt_stats()}')
+            if plan['inverter']:
+                reg_block = blocks['inverter']
+            if reg_block and models['inverter']['model'] not in (None, reg_block[0]):
+                # The model chain changed underneath us (e.g. firmware update), walk it again
+                logger.warning(f'Expected SunSpec model {models["inverter"]["model"]}, got {reg_block[0]}')
+                models = None
+                modelsStale = True
+                continue
             if reg_block:
-                # print(reg_block)
-                # reg_block[0] = Sun Spec DID
-                # reg_block[1] = Length of Model Block
-                # reg_block[2] = AC Total current value
-                # reg_block[3] = AC Phase A current value
-                # reg_block[4] = AC Phase B current value
-                # reg_block[5] = AC Phase C current value
-                # reg_block[6] = AC current scale factor
-                # reg_block[7] = AC Phase A to B voltage value
-                # reg_block[8] = AC Phase B to C voltage value
-                # reg_block[9] = AC Phase C to A voltage value
-                # reg_block[10] = AC Phase A to N voltage value
-                # reg_block[11] = AC Phase B to N voltage value
-                # reg_block[12] = AC Phase C to N voltage value
-                # reg_block[13] = AC voltage scale factor
-                # reg_block[14] = AC Power value
-                # reg_block[15] = AC Power scale factor
-                # reg_block[16] = AC Frequency value
-                # reg_block[17] = AC Frequency scale factor
-                # reg_block[18] = AC Apparent Power
-                # reg_block[19] = AC Apparent Power scale factor
-                # reg_block[20] = AC Reactive Power
-                # reg_block[21] = AC Reactive Power scale factor
-                # reg_block[22] = AC Power Factor
-                # reg_block[23] = AC Power Factor scale factor
-                # reg_block[24] = AC Lifetime Energy (HI bits)
-                # reg_block[25] = AC Lifetime Energy (LO bits)
-                # reg_block[26] = AC Lifetime Energy scale factor
-                # reg_block[27] = DC Current value
-                # reg_block[28] = DC Current scale factor
-                # reg_block[29] = DC Voltage value
-                # reg_block[30] = DC Voltage scale factor
-                # reg_block[31] = DC Power value
-                # reg_block[32] = DC Power scale factor
-                # reg_block[34] = Inverter temp
-                # reg_block[37] = Inverter temp scale factor
-                # reg_block[38] = Inverter Operating State
-                # reg_block[39] = Inverter Status Code
+                started = profiler.begin('decode')
                 datapoint = {
                     'measurement': 'SolarEdge',
                     'tags': {},
@@ -216,748 +2077,205 @@ async def write_to_influx(dbhost, dbport, mbmeters, period, dbname, legacysuppor
                 logger.debug(f'inverter reg_block: {str(reg_block)}')
                 datapoint['tags']['inverter'] = str(1)
 
-                data = BinaryPayloadDecoder.fromRegisters(reg_block, byteorder=Endian.Big, wordorder=Endian.Big)
-
-                # SunSpec DID
-                # Register 40069
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'SunSpec_DID'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal
-                else:
-                    dictInv[fooName] = 0.0
-
-                # SunSpec Length
-                # Register 40070
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'SunSpec_Length'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal
-                else:
-                    dictInv[fooName] = 0.0
-                
-                # AC Current
-                data.skip_bytes(8)
-                # Register 40075
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-10)
-                # Register 40071-40074
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_Current'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_CurrentA'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_CurrentB'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_CurrentC'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-
-                # AC Voltage
-                data.skip_bytes(14)
-                # Register 40082
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-14)
-                # Register 40077
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_VoltageAB'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_VoltageBC'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_VoltageCA'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_VoltageAN'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_VoltageBN'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_VoltageCN'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-
-                # AC Power
-                data.skip_bytes(4)
-                # Register 40084
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-4)
-                # Register 40083
-                fooVal = trunc_float(data.decode_16bit_int())
-                fooName = 'AC_Power'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-
-               # AC Frequency
-                data.skip_bytes(4)
-                # Register 40086
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-4)
-                # Register 40085
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'AC_Frequency'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-
-                # AC Apparent Power
-                data.skip_bytes(4)
-                # Register 40088
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-4)
-                # Register 40087
-                fooVal = trunc_float(data.decode_16bit_int())
-                fooName = 'AC_VA'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                
-                # AC Reactive Power
-                data.skip_bytes(4)
-                # Register 40090
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-4)
-                # Register 40089
-                fooVal = trunc_float(data.decode_16bit_int())
-                fooName = 'AC_VAR'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                
-                # AC Power Factor
-                data.skip_bytes(4)
-                # Register 40092
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-4)
-                # Register 40091
-                fooVal = trunc_float(data.decode_16bit_int())
-                fooName = 'AC_PF'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-
-                # AC Lifetime Energy Production
-                data.skip_bytes(6)
-                # Register 40095
-                scalefactor = 10**data.decode_16bit_uint()
-                data.skip_bytes(-6)
-                # Register 40093
-                fooVal = trunc_float(data.decode_32bit_uint())
-                fooName = 'AC_Energy_WH'
-                if fooVal < 4294967295:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                
-                # DC Current
-                data.skip_bytes(4)
-                # Register 40097
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-4)
-                # Register 40096
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'DC_Current'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-
-                # DC Voltage
-                data.skip_bytes(4)
-                # Register 40099
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-4)
-                # Register 40098
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'DC_Voltage'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-
-                # DC Power
-                data.skip_bytes(4)
-                # Register 40101
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-4)
-                # Register 40100
-                fooVal = trunc_float(data.decode_16bit_int())
-                fooName = 'DC_Power'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                
-                # Inverter Temp 
-                data.skip_bytes(10)
-                # Register 40106
-                scalefactor = 10**data.decode_16bit_int()
-                data.skip_bytes(-8)
-                # Register 40103
-                fooVal = trunc_float(data.decode_16bit_int())
-                fooName = 'Temp_Sink'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal * scalefactor
-                else:
-                    dictInv[fooName] = 0.0
-                
-                # Inverter Operating State
-                data.skip_bytes(6)
-                # Register 40107
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'Status'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal
-                else:
-                    dictInv[fooName] = 0.0
-                
-                # Inverter Operating Status Code
-                # Register 40108
-                fooVal = trunc_float(data.decode_16bit_uint())
-                fooName = 'Status_Vendor'
-                if fooVal < 65535:
-                    dictInv[fooName] = fooVal
-                else:
-                    dictInv[fooName] = 0.0
-
-                # Adding the ScaleFactor elements
-                dictInv['AC_Current_SF'] = 0.0
-                dictInv['AC_Voltage_SF'] = 0.0
-                dictInv['AC_Power_SF'] = 0.0
-                dictInv['AC_Frequency_SF'] = 0.0
-                dictInv['AC_VA_SF'] = 0.0
-                dictInv['AC_VAR_SF'] = 0.0
-                dictInv['AC_PF_SF'] = 0.0
-                dictInv['AC_Energy_WH_SF'] = 0.0
-                dictInv['DC_Current_SF'] = 0.0
-                dictInv['DC_Voltage_SF'] = 0.0
-                dictInv['DC_Power_SF'] = 0.0
-                dictInv['Temp_SF'] = 0.0
+                dictInv = decode_registers(reg_block, INVERTER_REGISTERS, INVERTER_SF_FIELDS)
+                profiler.end(started)
                 
                 logger.debug(f'Inverter')
                 for j, k in dictInv.items():
                     logger.debug(f'  {j}: {k}')
 
-                publish_metrics(dictInv, 'inverter', '')
+                with profiler.stage('publish'):
+                    publish_metrics(dictInv, 'inverter', '')
                 logger.debug('Done publishing inverter metrics...')
                              
-                datapoint['time'] = str(datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat())
+                datapoint['time'] = reg_block.timestamp
 
-                logger.debug(f'Writing to Influx: {str(datapoint)}')
-                await solar_client.write(datapoint)
+                lines = []
+                with profiler.stage('serialize'):
+                    if datapoint['fields']:
+                        lines.append(get_serializer(INVERTER_FIELDS, datapoint).serialize(datapoint['fields'], datapoint['time']))
+                    if energy is not None:
+                        lines.extend(energy.update(datapoint['tags'], dictInv, datapoint['time']))
+                if history is not None:
+                    history.record('inverter', dictInv, datapoint['time'])
+                if solar_client is not None and lines:
+                    logger.debug(f'Queueing for Influx: {lines}')
+                    solar_client.add(f'{client.host()}/inverter', lines)
 
-            else:
-                # Error during data receive
-                if client.last_error() == 2:
-                    logger.error(f'Failed to connect to SolarEdge inverter {client.host()}!')
-                elif client.last_error() == 3 or client.last_error() == 4:
-                    logger.error('Send or receive error!')
-                elif client.last_error() == 5:
-                    logger.error('Timeout during send or receive operation!')
+            elif plan['inverter']:
+                log_modbus_error(client)
                 await asyncio.sleep(period)
                     
-            for x in range(1, mbmeters+1):
+            for x in plan['meters']:
                 # Now loop through this for each meter that is attached.
                 logger.debug(f'Meter={str(x)}')
                 reg_block = {}
                 dictM = {}
 
-                # Start point is different for each meter
-                if x==1:
-                    reg_block = client.read_holding_registers(40188, 105)
-                if x==2:
-                    reg_block = client.read_holding_registers(40362, 105)
-                if x==3:
-                    reg_block = client.read_holding_registers(40537, 105)
+                # Meters whose common block could not be read yet are retried next cycle
+                if x not in dictMeterLabel:
+                    continue
+
+                reg_block = blocks['meters'][x]
+                if reg_block and models['meters'][x]['model'] not in (None, reg_block[0]):
+                    logger.warning(f'Expected SunSpec model {models["meters"][x]["model"]}, got {reg_block[0]}')
+                    models = None
+                    modelsStale = True
+                    break
                 if reg_block:
-                    # print(reg_block)
-                    # reg_block[0] = AC Total current value
-                    # reg_block[1] = AC Phase A current value
-                    # reg_block[2] = AC Phase B current value
-                    # reg_block[3] = AC Phase C current value
-                    # reg_block[4] = AC current scale factor
-                    # reg_block[5] = AC Phase Line (average) to N voltage value
-                    # reg_block[6] = AC Phase A to N voltage value
-                    # reg_block[7] = AC Phase B to N voltage value
-                    # reg_block[8] = AC Phase C to N voltage value
-                    # reg_block[9] = AC Phase Line to Line voltage value
-                    # reg_block[10] = AC Phase A to B voltage value
-                    # reg_block[11] = AC Phase B to C voltage value
-                    # reg_block[12] = AC Phase C to A voltage value
-                    # reg_block[13] = AC voltage scale factor
-                    # reg_block[14] = AC Frequency value
-                    # reg_block[15] = AC Frequency scale factor
-                    # reg_block[16] = Total Real Power
-                    # reg_block[17] = Phase A Real Power
-                    # reg_block[18] = Phase B Real Power
-                    # reg_block[19] = Phase C Real Power
-                    # reg_block[20] = Real Power scale factor
-                    # reg_block[21] = Total Apparent Power
-                    # reg_block[22] = Phase A Apparent Power
-                    # reg_block[23] = Phase B Apparent Power
-                    # reg_block[24] = Phase C Apparent Power
-                    # reg_block[25] = Apparent Power scale factor
-                    # reg_block[26] = Total Reactive Power
-                    # reg_block[27] = Phase A Reactive Power
-                    # reg_block[28] = Phase B Reactive Power
-                    # reg_block[29] = Phase C Reactive Power
-                    # reg_block[30] = Reactive Power scale factor
-                    # reg_block[31] = Average Power Factor
-                    # reg_block[32] = Phase A Power Factor
-                    # reg_block[33] = Phase B Power Factor
-                    # reg_block[34] = Phase C Power Factor
-                    # reg_block[35] = Power Factor scale factor
-                    # reg_block[36] = Total Exported Real Energy 
-                    # reg_block[38] = Phase A Exported Real Energy
-                    # reg_block[40] = Phase B Exported Real Energy
-                    # reg_block[42] = Phase C Exported Real Energy
-                    # reg_block[44] = Total Imported Real Energy
-                    # reg_block[46] = Phase A Imported Real Energy
-                    # reg_block[48] = Phase B Imported Real Energy
-                    # reg_block[50] = Phase C Imported Real Energy
-                    # reg_block[52] = Real Energy scale factor
-                    # reg_block[53] = Total Exported Real Energy 
-                    # reg_block[55] = Phase A Exported Real Energy
-                    # reg_block[57] = Phase B Exported Real Energy
-                    # reg_block[59] = Phase C Exported Real Energy
-                    # reg_block[61] = Total Imported Real Energy
-                    # reg_block[63] = Phase A Imported Real Energy
-                    # reg_block[65] = Phase B Imported Real Energy
-                    # reg_block[67] = Phase C Imported Real Energy
-                    # reg_block[69] = Real Energy scale factor
                     logger.debug(f'meter reg_block: {str(reg_block)}')
+                    started = profiler.begin('decode')
                 
                     # Set the Label to use for the Meter Metrics for Prometheus
-                    metriclabel = dictMeterLabel[x-1]
+                    metriclabel = dictMeterLabel[x]
                     # Clear data from inverter, otherwise we publish that again!
                     datapoint = {
                         'measurement': 'SolarEdge',
                         'tags': {
-                            'meter': dictMeterLabel[x-1]
+                            'meter': dictMeterLabel[x]
                         },
                         'fields': {}
                     }
-                    
-                    data = BinaryPayloadDecoder.fromRegisters(reg_block, byteorder=Endian.Big, wordorder=Endian.Big)
-
-                    # SunSpec DID
-                    # Register 40188
-                    fooVal = trunc_float(data.decode_16bit_uint())
-                    fooName = 'M_SunSpec_DID'
-                    if fooVal < 65535:
-                        dictM[fooName] = fooVal
-                    else:
-                        dictM[fooName] = 0.0
-
-                    # SunSpec Length
-                    # Register 40070
-                    fooVal = trunc_float(data.decode_16bit_uint())
-                    fooName = 'M_SunSpec_Length'
-                    if fooVal < 65535:
-                        dictM[fooName] = fooVal
-                    else:
-                        dictM[fooName] = 0.0
-
-                    # AC Current
-                    data.skip_bytes(8)
-                    # Register 40194
-                    scalefactor = 10**data.decode_16bit_int()
-                    data.skip_bytes(-10)
-                    # Register 40190-40193
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_Current'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_CurrentA'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_CurrentB'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_CurrentC'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-
-                   # AC Voltage
-                    data.skip_bytes(18)
-                    # Register 40203
-                    scalefactor = 10**data.decode_16bit_int()
-                    data.skip_bytes(-18)
-                    # Register 40195-40202
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VoltageLN'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VoltageAN'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VoltageBN'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VoltageCN'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VoltageLL'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VoltageAB'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VoltageBC'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VoltageCA'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-
-                    # AC Frequency
-                    data.skip_bytes(4)
-                    # Register 40205
-                    scalefactor = 10**data.decode_16bit_int()
-                    data.skip_bytes(-4)
-                    # Register 40204
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_Frequency'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    
-                    # AC Real Power
-                    data.skip_bytes(10)
-                    # Register 40210
-                    scalefactor = 10**data.decode_16bit_int()
-                    data.skip_bytes(-10)
-                    # Register 40206-40209
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_Power'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_Power_A'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_Power_B'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_Power_C'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    
-                    # AC Apparent Power
-                    data.skip_bytes(10)
-                    # Register 40215
-                    scalefactor = 10**data.decode_16bit_int()
-                    data.skip_bytes(-10)
-                    # Register 40211-40214
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VA'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VA_A'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VA_B'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VA_C'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-
-                    # AC Reactive Power
-                    data.skip_bytes(10)
-                    # Register 40220
-                    scalefactor = 10**data.decode_16bit_int()
-                    data.skip_bytes(-10)
-                    # Register 40216-40219
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VAR'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VAR_A'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VAR_B'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_VAR_C'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-
-                    # AC Power Factor
-                    data.skip_bytes(10)
-                    # Register 40225
-                    scalefactor = 10**data.decode_16bit_int()
-                    data.skip_bytes(-10)
-                    # Register 40221-40224
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_PF'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_PF_A'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_PF_B'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_16bit_int())
-                    fooName = 'M_AC_PF_C'
-                    if fooVal < 32768:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-
-                    # Accumulated AC Real Energy
-                    data.skip_bytes(34)
-                    # Register 40242
-                    scalefactor = 10**data.decode_16bit_int()
-                    data.skip_bytes(-34)
-                    # Register 40226-40240
-                    fooVal = trunc_float(data.decode_32bit_uint())
-                    fooName = 'M_Exported'
-                    if fooVal < 4294967295:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_32bit_uint())
-                    fooName = 'M_Exported_A'
-                    if fooVal < 4294967295:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_32bit_uint())
-                    fooName = 'M_Exported_B'
-                    if fooVal < 4294967295:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_32bit_uint())
-                    fooName = 'M_Exported_C'
-                    if fooVal < 4294967295:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_32bit_uint())
-                    fooName = 'M_Imported'
-                    if fooVal < 4294967295:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_32bit_uint())
-                    fooName = 'M_Imported_A'
-                    if fooVal < 4294967295:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_32bit_uint())
-                    fooName = 'M_Imported_B'
-                    if fooVal < 4294967295:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                    fooVal = trunc_float(data.decode_32bit_uint())
-                    fooName = 'M_Imported_C'
-                    if fooVal < 4294967295:
-                        dictM[fooName] = fooVal * scalefactor
-                    else:
-                        dictM[fooName] = 0.0
-                   
-                    # Accumulated AC Apparent Energy
-                    #logger.debug(f'Apparent Energy SF: {str(np.int16(reg_block[69]))}')
-                    #scalefactor = np.float_power(10,np.int16(reg_block[69]))
-                    #datapoint['fields']['M_Exported_VA'] = trunc_float(((reg_block[53] << 16) + reg_block[54]) * scalefactor) 
-                    #datapoint['fields']['M_Exported_VA_A'] = trunc_float(((reg_block[55] << 16) + reg_block[56]) * scalefactor)
-                    #datapoint['fields']['M_Exported_VA_B'] = trunc_float(((reg_block[57] << 16) + reg_block[58]) * scalefactor)
-                    #datapoint['fields']['M_Exported_VA_C'] = trunc_float(((reg_block[59] << 16) + reg_block[60]) * scalefactor)
-                    #datapoint['fields']['M_Imported_VA'] = trunc_float(((reg_block[61] << 16) + reg_block[62]) * scalefactor)
-                    #datapoint['fields']['M_Imported_VA_A'] = trunc_float(((reg_block[63] << 16) + reg_block[64]) * scalefactor)
-                    #datapoint['fields']['M_Imported_VA_B'] = trunc_float(((reg_block[65] << 16) + reg_block[66]) * scalefactor)
-                    #datapoint['fields']['M_Imported_VA_C'] = trunc_float(((reg_block[67] << 16) + reg_block[68]) * scalefactor)
-
-                    # Add the ScaleFactor elements
-                    dictM['M_AC_Current_SF'] = 0.0
-                    dictM['M_AC_Voltage_SF'] = 0.0
-                    dictM['M_AC_Frequency_SF'] = 0.0
-                    dictM['M_AC_Power_SF'] = 0.0
-                    dictM['M_AC_VA_SF'] = 0.0
-                    dictM['M_AC_VAR_SF'] = 0.0
-                    dictM['M_AC_PF_SF'] = 0.0
-                    dictM['M_Energy_W_SF'] = 0.0
-
-                    publish_metrics(dictM, 'meter', metriclabel, x, legacysupport)
-
-                    datapoint['time'] = str(datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat())
+
+                    dictM = decode_registers(reg_block, METER_REGISTERS, METER_SF_FIELDS)
+                    profiler.end(started)
+
+                    with profiler.stage('publish'):
+                        publish_metrics(dictM, 'meter', metriclabel, x, legacysupport)
+
+                    datapoint['time'] = reg_block.timestamp
 
                     logger.debug(f'Meter: {metriclabel}')
                     for j, k in dictM.items():
                         logger.debug(f'  {j}: {k}')
                         
-                    logger.debug(f'Writing to Influx: {str(datapoint)}')
-                    await solar_client.write(datapoint)
+                    lines = []
+                    with profiler.stage('serialize'):
+                        if datapoint['fields']:
+                            lines.append(get_serializer(METER_FIELDS, datapoint).serialize(datapoint['fields'], datapoint['time']))
+                        if energy is not None:
+                            lines.extend(energy.update(datapoint['tags'], dictM, datapoint['time']))
+                    if history is not None:
+                        history.record(f'meter{x}', dictM, datapoint['time'])
+                    if solar_client is not None and lines:
+                        logger.debug(f'Queueing for Influx: {lines}')
+                        solar_client.add(f'{client.host()}/meter{x}', lines)
 
                 else:
-                    # Error during data receive
-                    if client.last_error() == 2:
-                        logger.error(f'Failed to connect to SolarEdge inverter {client.host()}!')
-                    elif client.last_error() == 3 or client.last_error() == 4:
-                        logger.error('Send or receive error!')
-                    elif client.last_error() == 5:
-                        logger.error('Timeout during send or receive operation!')
+                    log_modbus_error(client)
                     await asyncio.sleep(period)
-                
-        except InfluxDBWriteError as e:
-            logger.error(f'Failed to write to InfluxDb: {e}')
+
+            if solar_client is not None:
+                solar_client.start_flush()
         except IOError as e:
             logger.error(f'I/O exception during operation: {e}')
         except Exception as e:
             logger.error(f'Unhandled exception: {e}')
 
-        await asyncio.sleep(period)
+        if history is not None:
+            history.trim(time.time_ns() // 1000000)
+        profiler.snapshot_allocations()
+        await asyncio.sleep(min([period] + list(cfg['intervals'].values())))
+
+############################################################
+
+def rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def startup_benchmark():
+    # Cost of the core and of each sink, to keep an eye on small (ARM) containers
+    print('*' * 60)
+    print('* Startup benchmark')
+    print('*' * 60)
+    rss = rss_kb()
+    print(f'Core:\t\tImport: {importTime * 1000:7.1f} ms\tRSS: {rss / 1024:6.1f} MB')
+    sinks = [
+        ('InfluxDB', lambda: __import__('aioinflux')),
+        ('Prometheus', lambda: exporter_handler() and __import__('http.server'))
+    ]
+    for name, load in sinks:
+        started = time.perf_counter()
+        try:
+            load()
+        except ImportError as e:
+            print(f'{name}:\tnot installed ({e})')
+            continue
+        elapsed = time.perf_counter() - started
+        before, rss = rss, rss_kb()
+        print(f'{name}:\tImport: {elapsed * 1000:7.1f} ms\tRSS: {rss / 1024:6.1f} MB (+{(rss - before) / 1024:.1f} MB)')
+
+importTime = time.perf_counter() - startTime
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('--config', help='JSON configuration file, watched for changes and applied without a restart')
     parser.add_argument('--influx_server', default='192.168.192.41')
     parser.add_argument('--influx_port', type=int, default=8086)
     parser.add_argument('--influx_database', default='solaredgetemp')
+    parser.add_argument('--influx_org', help='InfluxDB 2.x organization')
+    parser.add_argument('--influx_bucket', help='InfluxDB 2.x bucket, writes with the 2.x API instead of to --influx_database')
+    parser.add_argument('--influx_token', default=os.environ.get('INFLUX_TOKEN'), help='InfluxDB 2.x API token (default $INFLUX_TOKEN)')
     parser.add_argument('--inverter_port', type=int, default=1502, help='ModBus TCP port number to use')
     parser.add_argument('--unitid', type=int, default=1, help='ModBus unit id to use in communication')
-    parser.add_argument('--meters', type=int, default=0, help='Number of ModBus meters attached to inverter (0-3)')
+    parser.add_argument('--meters', type=meters_arg, default=0, help='Number of ModBus meters attached to inverter, or "auto" for all discovered meters')
+    parser.add_argument('--discovery', type=str2bool, default=True, help='Discover the SunSpec models instead of using the fixed register layout')
+    parser.add_argument('--discovery_cache', help='File to cache the discovered SunSpec models in')
     parser.add_argument('--prometheus_exporter_port', type=int, default=2112, help='Port on which the prometheus exporter will listen on')
     parser.add_argument('--interval', type=int, default=5, help='Time (seconds) between polling')
-    parser.add_argument('--legacy_support', type=bool, default=False, help='Set to true so Meter 1 prometheus metrics start with "M_" vs "M1_"')
-    parser.add_argument('inverter_ip', metavar='SolarEdge IP', help='IP address of the SolarEdge inverter to monitor')
+    parser.add_argument('--legacy_support', type=str2bool, default=False, help='Set to true so Meter 1 prometheus metrics start with "M_" vs "M1_"')
+    parser.add_argument('inverter_ip', metavar='SolarEdge IP', nargs='?', help='IP address of the SolarEdge inverter to monitor')
+    parser.add_argument('--proxy_port', type=int, help='Serve the polled registers to other ModBus TCP clients on this port')
+    parser.add_argument('--history_hours', type=float, help='Keep this many hours of compressed history, served on /history of the prometheus exporter port')
+    parser.add_argument('--energy_state', help='Enable the energy period totals and checkpoint them to this file')
+    parser.add_argument('--profiling', action='store_true', help='Enable the /debug/ profiling endpoints on the prometheus exporter port')
+    parser.add_argument('--startup_benchmark', action='store_true', help='Report the import time and memory of the core and each sink, then exit')
     parser.add_argument('--debug', '-d', action='count')
     args = parser.parse_args()
 
+    if args.startup_benchmark:
+        startup_benchmark()
+        sys.exit(0)
+
     logging.basicConfig()
     if args.debug and args.debug >= 1:
         logging.getLogger('solaredge').setLevel(logging.DEBUG)
     if args.debug and args.debug == 2:
         logging.getLogger('aioinflux').setLevel(logging.DEBUG)
 
+    baseconfig = config_from_args(args)
+    try:
+        if args.config:
+            config = load_config(args.config, baseconfig)
+        else:
+            config = validate_config(baseconfig)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    inverter = config['devices']['inverter']
+    influx = config['sinks'].get('influx')
+    prometheus = config['sinks'].get('prometheus')
     print(f'*' * 60)
     print(f'* Starting parameters')
     print(f'*' * 60)
-    print(f'Inverter:\tAddress: {args.inverter_ip}\n\t\tPort: {args.inverter_port}\n\t\tID: {args.unitid}')
-    print(f'Meters:\t\t{args.meters}')
-    print(f'InfluxDB:\tServer: {args.influx_server}:{args.influx_port}\n\t\tDatabase: {args.influx_database}')
-    print(f'Prometheus:\tExporter Port: {args.prometheus_exporter_port}\n')
-    print(f'Legacy Support:\t{args.legacy_support}\n')
-    logger.debug('Starting Prometheus exporter on port {args.prometheus_exporter_port}...')
-    start_http_server(args.prometheus_exporter_port)
-    #define_prometheus_metrics(args.meters)
+    if args.config:
+        print(f'Config:\t\t{args.config}')
+    print(f'Inverter:\tAddress: {inverter["host"]}\n\t\tPort: {inverter["port"]}\n\t\tID: {inverter["unitid"]}')
+    print(f'Meters:\t\t{config["devices"]["meters"]}')
+    if influx:
+        for endpoint in influx_endpoints(influx):
+            target = f'Org: {endpoint["org"]}\n\t\tBucket: {endpoint["bucket"]}' if endpoint.get('bucket') else f'Database: {endpoint["database"]}'
+            print(f'InfluxDB:\tServer: {endpoint["host"]}:{endpoint["port"]}\n\t\t{target}')
+    if prometheus:
+        print(f'Prometheus:\tExporter Port: {prometheus["port"]}\n')
+    print(f'Legacy Support:\t{config["legacy_support"]}\n')
     logger.debug('Running eventloop')
-    asyncio.get_event_loop().run_until_complete(write_to_influx(args.influx_server, args.influx_port, args.meters, args.interval, args.influx_database, args.legacy_support))
+    asyncio.get_event_loop().run_until_complete(write_to_influx(args.config, baseconfig))
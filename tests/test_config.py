@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import solaredge
+
+
+class ValidateConfigTest(unittest.TestCase):
+    def validate(self, override):
+        base = solaredge.merge_config(solaredge.DEFAULT_CONFIG, {'devices': {'inverter': {'host': 'inverter'}}})
+        return solaredge.validate_config(solaredge.merge_config(base, override))
+
+    def assertInvalid(self, override, message):
+        with self.assertRaises(ValueError) as raised:
+            self.validate(override)
+        self.assertIn(message, str(raised.exception))
+
+    def test_defaults(self):
+        cfg = self.validate({})
+        self.assertEqual(cfg['devices']['meters'], [])
+        self.assertEqual(cfg['sinks']['influx']['batch_size'], solaredge.INFLUX_DEFAULTS['batch_size'])
+
+    def test_section_types(self):
+        self.assertInvalid({'devices': 5}, 'devices must be an object')
+        self.assertInvalid({'proxy': []}, 'proxy must be an object')
+        self.assertInvalid({'sinks': {'influx': 'localhost'}}, 'sinks.influx must be an object')
+
+    def test_unknown_keys(self):
+        self.assertInvalid({'devices': {'inverter': {'hots': 'inverter'}}}, 'devices.inverter.hots')
+        self.assertInvalid({'history': {'hour': 2}}, 'history.hour')
+        self.assertInvalid({'sinks': {'influx': {'endpoints': [{'host': 'a', 'port': 8086, 'db': 'x'}]}}},
+                           'sinks.influx.endpoints[0].db')
+        # Intervals and deadbands are keyed by group and field
+        self.validate({'intervals': {'meters': 30}, 'deadbands': {'AC_Power': 5}})
+
+    def test_values(self):
+        self.assertInvalid({'interval': 0}, 'interval must be a positive number')
+        self.assertInvalid({'devices': {'inverter': {'port': '1502'}}}, 'devices.inverter.port must be an integer')
+        self.assertInvalid({'devices': {'inverter': {'min_timeout': 60}}}, 'min_timeout must not be larger')
+        self.assertInvalid({'proxy': {'host': 5}}, 'proxy.host')
+        self.assertInvalid({'proxy': {'port': True}}, 'proxy.port')
+
+    def test_meters(self):
+        self.assertEqual(self.validate({'devices': {'meters': 2}})['devices']['meters'], [1, 2])
+        self.assertEqual(self.validate({'devices': {'meters': [3, 1, 1]}})['devices']['meters'], [1, 3])
+        self.assertEqual(self.validate({'devices': {'meters': 'auto'}})['devices']['meters'], 'auto')
+        without = {'discovery': {'enabled': False}}
+        self.assertInvalid(dict(without, devices={'meters': 'auto'}), 'cannot be auto')
+        self.assertInvalid(dict(without, devices={'meters': 4}), 'between 0 and 3')
+        self.assertInvalid({'devices': {'meters': [True]}}, 'list of meter numbers')
+
+    def test_influx_endpoints(self):
+        cfg = self.validate({'sinks': {'influx': {'routing': 'replicate', 'endpoints': [
+            {'host': 'a', 'port': 8086, 'database': 'solaredge'},
+            {'host': 'b', 'port': 8086, 'org': 'home', 'bucket': 'solaredge', 'token': 'secret'}]}}})
+        self.assertEqual(len(solaredge.influx_endpoints(cfg['sinks']['influx'])), 2)
+        self.assertInvalid({'sinks': {'influx': {'endpoints': 'a'}}}, 'must be a non-empty list')
+        self.assertInvalid({'sinks': {'influx': {'bucket': 'solaredge', 'org': 'home'}}}, 'sinks.influx.token is required')
+        self.assertInvalid({'sinks': {'influx': {'routing': 'random'}}}, 'sinks.influx.routing')
+        self.assertInvalid({'sinks': {'influx': {'max_buffer': 0}}}, 'sinks.influx.max_buffer')
+        # A sink can be switched off
+        self.assertIsNone(self.validate({'sinks': {'influx': None}})['sinks']['influx'])
+
+
+if __name__ == '__main__':
+    unittest.main()
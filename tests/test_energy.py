@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import solaredge
+
+
+class EnergyAccumulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.midnight = solaredge.next_day(solaredge.day_start(1700000000))
+
+    def accumulator(self, state=None):
+        return solaredge.EnergyAccumulator({'state': state, 'interval': 900, 'checkpoint': 60,
+                                            'fields': ['AC_Energy_WH']})
+
+    def update(self, accumulator, value, ts):
+        # The period totals written, as {(period, start): total}
+        totals = {}
+        for line in accumulator.update({'inverter': 'test'}, {'AC_Energy_WH': value}, int(ts * 1e9)):
+            series, fields, stamp = line.decode().split(' ')
+            period = series.split('period=')[1]
+            totals[(period, int(stamp) // 1000000000)] = float(fields.split('=')[1])
+        return totals
+
+    def test_counter_reset(self):
+        accumulator = self.accumulator()
+        self.update(accumulator, 1000, self.midnight + 60)
+        self.update(accumulator, 1500, self.midnight + 120)
+        # A replaced meter starts from zero, what it counted since is added
+        totals = self.update(accumulator, 200, self.midnight + 180)
+        self.assertEqual(totals[('day', self.midnight)], 700.0)
+
+    def test_gap_is_spread_over_midnight(self):
+        accumulator = self.accumulator()
+        self.update(accumulator, 0, self.midnight - 1800)
+        totals = self.update(accumulator, 3600, self.midnight + 1800)
+        self.assertEqual(totals[('day', solaredge.day_start(self.midnight - 1800))], 1800.0)
+        self.assertEqual(totals[('day', self.midnight)], 1800.0)
+        for start in range(int(self.midnight) - 1800, int(self.midnight) + 1800, 900):
+            self.assertEqual(totals[('interval', start)], 900.0)
+
+    def test_restart_keeps_counters(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = os.path.join(directory, 'energy.json')
+            accumulator = self.accumulator(state)
+            self.update(accumulator, 1000, self.midnight + 60)
+            accumulator.checkpoint(force=True)
+            # The energy produced while the tool was down is counted after the restart
+            totals = self.update(self.accumulator(state), 1300, self.midnight + 960)
+            self.assertEqual(totals[('day', self.midnight)], 300.0)
+            self.assertEqual(totals[('interval', self.midnight)], 280.0)
+            self.assertEqual(totals[('interval', self.midnight + 900)], 20.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import solaredge
+
+
+class HistoryChunkTest(unittest.TestCase):
+    def roundtrip(self, samples):
+        chunk = solaredge.HistoryChunk(*samples[0])
+        for ts, value in samples[1:]:
+            chunk.append(ts, value)
+        self.assertEqual(list(chunk.samples()), samples)
+
+    def test_bucket_edges(self):
+        # Delta-of-deltas on and around the edge of every bucket, both signs
+        for bits in (7, 9, 12, 32):
+            for dod in (1 << (bits - 1), -(1 << (bits - 1)), (1 << (bits - 1)) - 1, -(1 << (bits - 1)) - 1):
+                ts = 1700000000000
+                samples = [(ts, 1.0), (ts + 1000, 2.0)]
+                samples.append((ts + 2000 + dod, 3.0))
+                samples.append((samples[-1][0] + 1000 + dod, 3.0))
+                with self.subTest(dod=dod):
+                    self.roundtrip(samples)
+
+    def test_jittered_polls(self):
+        rng = random.Random(1)
+        ts = 1700000000000
+        samples = []
+        for i in range(2000):
+            ts += 5000 + rng.randint(-300, 300)
+            samples.append((ts, rng.choice([230.0, 230.1, rng.random() * 5000, 0.0])))
+        self.roundtrip(samples)
+
+
+
+class HistoryBufferTest(unittest.TestCase):
+    def buffer(self, **cfg):
+        return solaredge.HistoryBuffer(dict({'hours': 1, 'chunk': 600, 'max_bytes': 1 << 20}, **cfg))
+
+    def test_budget_holds_for_single_chunks(self):
+        history = self.buffer(max_bytes=1000)
+        now = 1700000000000
+        for i in range(100):
+            history.record('inverter', {f'field{i}': float(i)}, now * 1000000)
+        history.trim(now)
+        size = sum(chunk.size() for series in history.series.values() for chunk in series)
+        self.assertLessEqual(size, 1000)
+        self.assertIn('field99', history.fields()['inverter'])
+        self.assertNotIn('field0', history.fields()['inverter'])
+
+    def test_retention(self):
+        history = self.buffer(chunk=10)
+        now = 1700000000000
+        for ts in range(now - 7200 * 1000, now, 5000):
+            history.record('inverter', {'AC_Power': 1.0}, ts * 1000000)
+        history.trim(now)
+        points = history.query('inverter', 'AC_Power', 0, now, None)
+        self.assertGreaterEqual(points[0][0], now - 3600 * 1000 - 10 * 1000)
+        self.assertEqual(points[-1][0], now - 5000)
+
+    def test_query_steps(self):
+        history = self.buffer()
+        now = 1700000000000
+        for i, value in enumerate((1.0, 2.0, 3.0)):
+            history.record('inverter', {'AC_Power': value}, (now + i * 5000) * 1000000)
+        self.assertEqual(history.query('inverter', 'AC_Power', now, now + 5000, None), [(now, 1.0), (now + 5000, 2.0)])
+        self.assertEqual(history.query('inverter', 'AC_Power', now, now + 60000, 60000), [(now - now % 60000, 2.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
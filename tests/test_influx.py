@@ -0,0 +1,134 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import solaredge
+
+
+class WriteError(Exception):
+    def __init__(self, status=None):
+        super().__init__(f'status {status}')
+        self.status = status
+
+
+class InfluxEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.errors = solaredge.influxErrors
+        solaredge.influxErrors = (WriteError,)
+        self.endpoint = solaredge.InfluxEndpoint({'host': 'influx', 'port': 8086, 'database': 'solaredge'},
+                                                 {'batch_size': 5, 'flush_interval': 0, 'max_buffer': 10})
+        self.endpoint.opened = True
+        self.sent = []
+
+    def tearDown(self):
+        solaredge.influxErrors = self.errors
+
+    def lines(self, start, end):
+        return [b'line%d' % i for i in range(start, end)]
+
+    def test_lines_added_during_a_write(self):
+        async def run():
+            release = asyncio.Event()
+
+            async def post(body):
+                await release.wait()
+                self.sent.extend(body.split(b'\n'))
+            self.endpoint.post = post
+            self.endpoint.add(self.lines(0, 10))
+            flush = asyncio.ensure_future(self.endpoint.flush())
+            await asyncio.sleep(0)
+            # The buffer is full, but the batch in flight must not be trimmed into
+            self.endpoint.add(self.lines(10, 13))
+            release.set()
+            await flush
+        asyncio.run(run())
+        self.assertEqual(self.sent, self.lines(0, 13))
+        self.assertEqual(self.endpoint.buffer, [])
+
+    def test_failed_batch_is_kept(self):
+        async def post(body):
+            raise WriteError(500)
+        self.endpoint.post = post
+        self.endpoint.add(self.lines(0, 7))
+        asyncio.run(self.endpoint.flush())
+        self.assertEqual(self.endpoint.buffer, self.lines(0, 7))
+        self.assertGreater(self.endpoint.retryAt, 0)
+        self.assertFalse(self.endpoint.due(0))
+
+    def test_failed_batch_respects_max_buffer(self):
+        async def run():
+            release = asyncio.Event()
+
+            async def post(body):
+                await release.wait()
+                raise WriteError(503)
+            self.endpoint.post = post
+            self.endpoint.add(self.lines(0, 10))
+            flush = asyncio.ensure_future(self.endpoint.flush())
+            await asyncio.sleep(0)
+            self.endpoint.add(self.lines(10, 13))
+            release.set()
+            await flush
+        asyncio.run(run())
+        # The oldest lines go first
+        self.assertEqual(self.endpoint.buffer, self.lines(3, 13))
+
+    def test_rejected_batch_is_dropped(self):
+        async def post(body):
+            if b'line0' in body:
+                raise WriteError(400)
+            self.sent.extend(body.split(b'\n'))
+        self.endpoint.post = post
+        self.endpoint.add(self.lines(0, 7))
+        asyncio.run(self.endpoint.flush())
+        self.assertEqual(self.sent, self.lines(5, 7))
+        self.assertEqual(self.endpoint.buffer, [])
+
+    def test_failed_open_backs_off(self):
+        async def open():
+            raise ConnectionError('refused')
+        self.endpoint.opened = False
+        self.endpoint.open = open
+        self.endpoint.add(self.lines(0, 3))
+        asyncio.run(self.endpoint.flush())
+        self.assertEqual(self.endpoint.buffer, self.lines(0, 3))
+        self.assertEqual(self.endpoint.failures, 1)
+        self.assertFalse(self.endpoint.due(0))
+
+
+class InfluxSinkTest(unittest.TestCase):
+    def config(self, hosts, **settings):
+        sinkcfg = dict(solaredge.INFLUX_DEFAULTS, **settings)
+        sinkcfg['endpoints'] = [{'host': host, 'port': 8086, 'database': 'solaredge'} for host in hosts]
+        return sinkcfg
+
+    def test_unchanged_endpoints_are_kept(self):
+        first = solaredge.InfluxSink(self.config(['a', 'b']))
+        first.endpoints[0].add([b'pending'])
+        second = solaredge.InfluxSink(self.config(['a', 'c'], batch_size=10), first.endpoints)
+        self.assertIs(second.endpoints[0], first.endpoints[0])
+        self.assertEqual(second.endpoints[0].buffer, [b'pending'])
+        self.assertEqual(second.endpoints[0].batchSize, 10)
+        self.assertEqual([endpoint.name for endpoint in second.retired], ['b:8086/solaredge'])
+
+    def test_hash_routing_is_stable(self):
+        sink = solaredge.InfluxSink(self.config(['a', 'b', 'c']))
+        routes = {f'10.0.0.{i}/inverter': sink.route(f'10.0.0.{i}/inverter')[0].name for i in range(50)}
+        self.assertEqual(len(set(routes.values())), 3)
+        # Removing an endpoint only moves the devices that were on it
+        smaller = solaredge.InfluxSink(self.config(['a', 'b']))
+        for key, name in routes.items():
+            if name != 'c:8086/solaredge':
+                self.assertEqual(smaller.route(key)[0].name, name)
+
+    def test_replicate(self):
+        sink = solaredge.InfluxSink(self.config(['a', 'b'], routing='replicate'))
+        sink.add('inverter', [b'line'])
+        self.assertEqual([endpoint.buffer for endpoint in sink.endpoints], [[b'line'], [b'line']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import solaredge
+
+
+class FakeDevice:
+    # ModBus TCP server that answers reads with the register addresses as values. The
+    # answer to each request comes from respond(pdu, connection), None leaves it unanswered
+    # and an empty answer is sent as a broken frame with MBAP length 0.
+    def __init__(self, respond=None):
+        self.respond = respond or self.registers
+        self.connections = 0
+
+    async def registers(self, pdu, connection):
+        fc, address, count = struct.unpack('>BHH', pdu)
+        return struct.pack(f'>BB{count}H', fc, count * 2, *range(address, address + count))
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        connection = self.connections
+        try:
+            while True:
+                tid, pid, length, unit = struct.unpack('>HHHB', await reader.readexactly(7))
+                pdu = await reader.readexactly(length - 1)
+                asyncio.ensure_future(self.answer(writer, tid, unit, pdu, connection))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, writer, tid, unit, pdu, connection):
+        response = await self.respond(pdu, connection)
+        if response is not None and not writer.is_closing():
+            writer.write(struct.pack('>HHHB', tid, 0, len(response) + 1 if response else 0, unit) + response)
+
+
+class ModbusTransportTest(unittest.TestCase):
+    def run_device(self, device, test, timeout=1, pipeline=4):
+        async def run():
+            port = await device.start()
+            transport = solaredge.ModbusTransport('127.0.0.1', port, 1, timeout, pipeline)
+            try:
+                await test(transport)
+            finally:
+                transport.close()
+                device.server.close()
+        asyncio.run(run())
+
+    def test_out_of_order_responses(self):
+        async def respond(pdu, connection):
+            # Later requests are answered first
+            fc, address, count = struct.unpack('>BHH', pdu)
+            await asyncio.sleep((40400 - address) / 4000)
+            return await device.registers(pdu, connection)
+        device = FakeDevice(respond)
+
+        async def test(transport):
+            blocks = await asyncio.gather(*[transport.read_holding_registers(address, 10)
+                                            for address in (40000, 40100, 40200, 40300)])
+            for address, block in zip((40000, 40100, 40200, 40300), blocks):
+                self.assertEqual(block, list(range(address, address + 10)))
+            self.assertEqual(transport.depth, 4)
+        self.run_device(device, test)
+
+    def test_timeout_falls_back(self):
+        answered = set()
+
+        async def respond(pdu, connection):
+            # The first request for each block stays unanswered while another is in flight
+            fc, address, count = struct.unpack('>BHH', pdu)
+            if address != 40000 and address not in answered:
+                answered.add(address)
+                return None
+            await asyncio.sleep(0.05)
+            return await device.registers(pdu, connection)
+        device = FakeDevice(respond)
+
+        async def test(transport):
+            blocks = await asyncio.gather(transport.read_holding_registers(40000, 10),
+                                          transport.read_holding_registers(40100, 10))
+            self.assertEqual(blocks, [list(range(40000, 40010)), list(range(40100, 40110))])
+            self.assertEqual(transport.depth, 1)
+        self.run_device(device, test, timeout=0.3)
+
+    def test_pipelining_regrows(self):
+        device = FakeDevice()
+
+        async def test(transport):
+            transport.fallback('timed out')
+            for i in range(solaredge.PIPELINE_RETRY - 1):
+                await transport.read_holding_registers(40000, 10)
+            self.assertEqual(transport.depth, 1)
+            await transport.read_holding_registers(40000, 10)
+            self.assertEqual(transport.depth, 4)
+            # The next fallback waits longer
+            transport.fallback('timed out')
+            self.assertEqual(transport.serialRetry, solaredge.PIPELINE_RETRY * 2)
+        self.run_device(device, test)
+
+    def test_reconnect_after_timeouts(self):
+        async def respond(pdu, connection):
+            # The first session stops answering
+            return None if connection == 1 else await device.registers(pdu, connection)
+        device = FakeDevice(respond)
+
+        async def test(transport):
+            for i in range(solaredge.MB_RECONNECT_TIMEOUTS):
+                self.assertIsNone(await transport.read_holding_registers(40000, 10))
+                self.assertEqual(transport.last_error(), solaredge.MB_TIMEOUT_ERR)
+            self.assertEqual(await transport.read_holding_registers(40000, 10), list(range(40000, 40010)))
+            self.assertEqual(device.connections, 2)
+        self.run_device(device, test, timeout=0.2, pipeline=1)
+
+    def test_reconnect_after_broken_frame(self):
+        async def respond(pdu, connection):
+            return b'' if connection == 1 else await device.registers(pdu, connection)
+        device = FakeDevice(respond)
+
+        async def test(transport):
+            self.assertIsNone(await transport.read_holding_registers(40000, 10))
+            self.assertEqual(transport.last_error(), solaredge.MB_RECV_ERR)
+            self.assertEqual(await transport.read_holding_registers(40000, 10), list(range(40000, 40010)))
+            self.assertEqual(device.connections, 2)
+        self.run_device(device, test, pipeline=1)
+
+    def test_split_reads(self):
+        async def respond(pdu, connection):
+            # A gateway that accepts at most 60 registers, and no registers past 40400
+            fc, address, count = struct.unpack('>BHH', pdu)
+            if address + count > 40400:
+                return bytes([fc | 0x80, 0x02])
+            if count > 60:
+                return bytes([fc | 0x80, solaredge.MODBUS_ILLEGAL_DATA_VALUE])
+            return await device.registers(pdu, connection)
+        device = FakeDevice(respond)
+
+        async def test(transport):
+            self.assertEqual(await transport.read_holding_registers(40000, 110), list(range(40000, 40110)))
+            self.assertEqual(transport.maxRead, 55)
+            self.assertEqual(await transport.read_holding_registers(40100, 110), list(range(40100, 40210)))
+            # Other exceptions are not split
+            self.assertIsNone(await transport.read_holding_registers(40350, 100))
+            self.assertEqual(transport.last_error(), solaredge.MB_EXCEPT_ERR)
+            self.assertEqual(transport.last_except(), 0x02)
+        self.run_device(device, test)
+
+
+if __name__ == '__main__':
+    unittest.main()